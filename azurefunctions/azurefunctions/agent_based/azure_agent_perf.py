@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+from cmk.agent_based.v2 import AgentSection
+from cmk.agent_based.v2 import CheckPlugin
+from cmk.agent_based.v2 import Service
+from cmk.agent_based.v2 import Result
+from cmk.agent_based.v2 import State
+from cmk.agent_based.v2 import check_levels
+from cmk.agent_based.v2 import render
+import json
+import traceback
+from itertools import chain
+
+
+# the azure_agent_perf section is printed by both agent_azurefunctions
+# and agent_azuremonitor, one json line per agent run: this plugin is
+# packaged here only, as a section can be registered once in CheckMK
+
+
+def parse_azure_agent_perf(string_table):
+    parsed = {}
+    for line in chain.from_iterable(string_table):
+        try:
+            perf = json.loads(line)
+            parsed[perf['agent']] = perf
+        except (ValueError, KeyError, TypeError):
+            continue
+    return parsed
+
+
+def discover_azure_agent_perf(section):
+    # yield one service per agent
+    for agent in section:
+        yield Service(item=agent)
+
+
+def check_azure_agent_perf(item, params, section):
+    try:
+        perf = section.get(item)
+        if perf is None:
+            return
+
+        yield from check_levels(
+            perf['total'],
+            label="Runtime",
+            metric_name="azure_agent_runtime",
+            levels_upper=params.get('runtime'),
+            render_func=render.timespan,
+        )
+
+        # phases run concurrently for several targets or queries, so
+        # their times are summed up and can exceed the runtime
+        for phase, secs in perf['phases'].items():
+            yield from check_levels(
+                secs,
+                label=f"{phase.capitalize()} time",
+                metric_name=f"azure_agent_{phase}_time",
+                levels_upper=params.get(phase),
+                render_func=render.timespan,
+                notice_only=True,
+            )
+
+        counters = perf['counters']
+        yield from check_levels(
+            counters['retries'],
+            label="HTTP retries",
+            metric_name="azure_agent_retries",
+            levels_upper=params.get('retries'),
+            render_func=lambda v: "%d" % int(v),
+        )
+        yield from check_levels(
+            counters['requests'],
+            label="HTTP requests",
+            metric_name="azure_agent_requests",
+            render_func=lambda v: "%d" % int(v),
+            notice_only=True,
+        )
+        yield from check_levels(
+            counters['rows'],
+            label="Rows",
+            metric_name="azure_agent_rows",
+            render_func=lambda v: "%d" % int(v),
+            notice_only=True,
+        )
+        yield from check_levels(
+            counters['bytes'],
+            label="Received",
+            metric_name="azure_agent_bytes",
+            render_func=render.bytes,
+            notice_only=True,
+        )
+    except Exception as e:
+        yield Result(
+            state=State.UNKNOWN,
+            summary=f'Check crash: {e}',
+            details=traceback.format_exc(),
+        )
+
+
+agent_section_azure_agent_perf = AgentSection(
+    name="azure_agent_perf",
+    parse_function=parse_azure_agent_perf,
+)
+
+check_plugin_azure_agent_perf = CheckPlugin(
+    name="azure_agent_perf",
+    service_name="Azure agent %s performance",
+    discovery_function=discover_azure_agent_perf,
+    check_function=check_azure_agent_perf,
+    check_default_parameters={
+        'runtime': ('fixed', (30.0, 50.0)),
+    },
+    check_ruleset_name="azure_agent_perf",
+)
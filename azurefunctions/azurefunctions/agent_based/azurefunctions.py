@@ -6,9 +6,13 @@ from cmk.agent_based.v2 import Service
 from cmk.agent_based.v2 import Result
 from cmk.agent_based.v2 import State
 from cmk.agent_based.v2 import check_levels
+from cmk.agent_based.v2 import render
 from cmk.utils import debug
 from pprint import pprint
+import bisect
 import json
+import math
+import time
 import traceback
 from itertools import chain
 from datetime import datetime, timezone
@@ -16,6 +20,156 @@ from datetime import datetime, timezone
 from croniter import croniter
 
 
+class Invocation:
+    """A function invocation logged in App Insights."""
+
+    __slots__ = ('timestamp', 'success', 'result_code', 'duration', 'weight')
+
+    def __init__(self, timestamp, success, result_code, duration, weight=1):
+        # epoch seconds
+        self.timestamp = timestamp
+        self.success = success
+        # int, unless App Insights logged a non numeric code
+        self.result_code = result_code
+        # milliseconds
+        self.duration = duration
+        # requests represented by the log, its itemCount
+        self.weight = weight
+
+
+def _parse_result_code(result_code):
+    try:
+        return int(result_code)
+    except (TypeError, ValueError):
+        return result_code
+
+
+def _invocation_from_dict(log):
+    # section version 1: raw App Insights values
+    return Invocation(
+        datetime.fromisoformat(log['timestamp']).timestamp(),
+        log.get('success') == 'True',
+        _parse_result_code(log.get('resultCode')),
+        float(log.get('duration') or 0),
+    )
+
+
+def _sorted_recent(invocations):
+    # the recent invocations of the aggregated query come in no
+    # particular order: the checks expect the latest first
+    return sorted(invocations, key=lambda log: log.timestamp, reverse=True)
+
+
+def _parse_section_v1(lines):
+    # one json object per line, either an App Insights log or, in
+    # aggregated query mode, the invocation statistics of a function
+    logs = {}
+    stats = {}
+    for line in lines:
+        record = json.loads(line)
+        key = (record['cloud_RoleName'], record['operation_Name'])
+        if 'invocations' in record:
+            record['recent'] = _sorted_recent(
+                _invocation_from_dict(log) for log in record['recent'])
+            stats[key] = record
+        else:
+            logs.setdefault(key, []).append(_invocation_from_dict(record))
+    return logs, stats
+
+
+def _parse_section_v2(header, lines):
+    # one json array per line, whose first element is the record kind
+    # ('l' for logs, 's' for statistics, 'e' for errors, 'w' and 't'
+    # for sampled logs and their totals) and the others are the values
+    # of the columns of that kind, as listed in the header
+    columns = header['columns']
+    logcol = {c: i + 1 for i, c in enumerate(columns['l'])}
+    statcol = {c: i + 1 for i, c in enumerate(columns['s'])}
+    invcol = {c: i for i, c in enumerate(columns['i'])}
+
+    def _invocation(row, col):
+        return Invocation(
+            row[col['timestamp']],
+            row[col['success']],
+            row[col['resultCode']],
+            row[col['duration']],
+        )
+
+    # errors and samples are missing from sections of older agents
+    errcol = {c: i + 1 for i, c in enumerate(columns.get('e', []))}
+    samplecol = {c: i + 1 for i, c in enumerate(columns.get('w', []))}
+    totalcol = {c: i + 1 for i, c in enumerate(columns.get('t', []))}
+
+    logs = {}
+    stats = {}
+    errors = {}
+    totals = {}
+    for line in lines:
+        row = json.loads(line)
+        if row[0] == 'l':
+            key = (row[logcol['cloud_RoleName']],
+                   row[logcol['operation_Name']])
+            logs.setdefault(key, []).append(_invocation(row, logcol))
+        elif row[0] == 's':
+            key = (row[statcol['cloud_RoleName']],
+                   row[statcol['operation_Name']])
+            record = {col: row[i] for col, i in statcol.items()}
+            record['recent'] = _sorted_recent(
+                _invocation(inv, invcol) for inv in record['recent'])
+            stats[key] = record
+        elif row[0] == 'e':
+            # app None: the error affects every app
+            errors.setdefault(row[errcol['cloud_RoleName']], []).append(
+                row[errcol['error']])
+        elif row[0] == 'w':
+            key = (row[samplecol['cloud_RoleName']],
+                   row[samplecol['operation_Name']])
+            invocation = _invocation(row, samplecol)
+            invocation.weight = row[samplecol['itemCount']]
+            logs.setdefault(key, []).append(invocation)
+        elif row[0] == 't':
+            key = (row[totalcol['cloud_RoleName']],
+                   row[totalcol['operation_Name']])
+            totals[key] = {
+                'rows': row[totalcol['rows']],
+                'items': row[totalcol['items']],
+            }
+    return logs, stats, errors, totals
+
+
+def _parse_sharded(blocks):
+    # the agents of sharded collector nodes each send to the host a
+    # section with their own apps, which CheckMK concatenates: an error
+    # of a whole target (app None) affects only the apps of its node
+    apps, logs, stats, errors, totals = {}, {}, {}, {}, {}
+    for header, block in blocks:
+        block_apps = json.loads(block[0])
+        block_logs, block_stats, block_errors, block_totals = \
+            _parse_section_v2(header, block[1:])
+        if block_apps and None in block_errors:
+            for appname in block_apps:
+                block_errors.setdefault(appname, []).extend(
+                    block_errors[None])
+            del block_errors[None]
+        apps.update(block_apps)
+        logs.update(block_logs)
+        stats.update(block_stats)
+        totals.update(block_totals)
+        for appname, messages in block_errors.items():
+            errors.setdefault(appname, []).extend(messages)
+    return apps, logs, stats, errors, totals
+
+
+def _section_blocks(input_list):
+    # (header, lines) of each section, headers start with the version
+    starts = [i for i, line in enumerate(input_list)
+              if line.startswith('{"version"')]
+    return [
+        (json.loads(input_list[start]), input_list[start + 1:end])
+        for start, end in zip(starts, starts[1:] + [len(input_list)])
+    ]
+
+
 def parse_azurefunctions(string_table):
     # string_table is a list of lists, each inner list is one line of
     # the stdout in ../libexec/agent_azurefunctions
@@ -24,13 +178,48 @@ def parse_azurefunctions(string_table):
         # flatten the list because it has every element wrapped in another list
         input_list = list(chain.from_iterable(string_table))
 
-        apps = input_list[0]
-        logs = input_list[1:]
-        dictlogs = [json.loads(log) for log in logs]
+        # version 1 of the section has no header and starts with the
+        # function apps, whose values are lists and not a version number
+        header = json.loads(input_list[0])
+        if isinstance(header.get('version'), int):
+            blocks = _section_blocks(input_list)
+            if len(blocks) > 1:
+                apps, logs, stats, errors, totals = _parse_sharded(blocks)
+            else:
+                apps = json.loads(input_list[1])
+                logs, stats, errors, totals = _parse_section_v2(
+                    header, input_list[2:])
+            window = header.get('window')
+            levels = header.get('levels', {})
+        else:
+            apps = header
+            logs, stats = _parse_section_v1(input_list[1:])
+            errors = {}
+            totals = {}
+            window = None
+            levels = {}
+
+        # index everything by (app name, function name), so that each
+        # check only looks up its own function
+        funcs = {
+            (appname, func['name']): func
+            for appname, appfuncs in apps.items()
+            for func in appfuncs
+        }
 
         parsed = {
-            'apps': json.loads(apps),
-            'logs': dictlogs,
+            'apps': apps,
+            'funcs': funcs,
+            'logs': logs,
+            'stats': stats,
+            # rows and items of the sampled functions
+            'totals': totals,
+            # errors of the agent, by app name
+            'errors': errors,
+            # seconds covered by the logs, if known
+            'window': window,
+            # upper levels by metric, from the special agent rule
+            'levels': levels,
             'error': None,
         }
 
@@ -40,7 +229,13 @@ def parse_azurefunctions(string_table):
     except Exception as e:
         parsed = {
             'apps': {},
+            'funcs': {},
             'logs': [f'parsing failed: {e}'],
+            'stats': {},
+            'totals': {},
+            'errors': {},
+            'window': None,
+            'levels': {},
             'error': traceback.format_exc(),
         }
 
@@ -54,96 +249,444 @@ def discover_azurefunctions(section):
             yield Service(item=f"{appname} - {func['name']}")
 
 
-def _check_duration(duration_avg):
+def _fmt_duration(millis):
+    if millis > 2000:
+        secs = millis / 1000
+        return "%.3f s" % secs
+    return "%d ms" % int(millis)
 
-    def _fmt_duration(millis):
-        if millis > 2000:
-            secs = millis / 1000
-            return "%.3f s" % secs
-        return "%d ms" % int(millis)
 
+DURATION_PERCENTILES = [
+    ('duration_p50', "P50 duration"),
+    ('duration_p95', "P95 duration"),
+    ('duration_p99', "P99 duration"),
+    ('duration_max', "Max duration"),
+]
+
+
+def _upper_levels(section, metric, default=None):
+    # levels of the rule, None if the rule disables them, else default
+    if metric not in section['levels']:
+        return default
+    levels = section['levels'][metric]
+    return ("fixed", tuple(levels)) if levels else None
+
+
+def _check_duration(funcstats, section):
     yield from check_levels(
-        duration_avg,
+        funcstats['duration_avg'] or 0,
         label="Duration",
         metric_name="duration",
+        levels_upper=_upper_levels(section, 'duration_avg'),
         render_func=_fmt_duration,
     )
 
+    # percentiles are missing from sections of older agents
+    for key, label in DURATION_PERCENTILES:
+        if funcstats.get(key) is None:
+            continue
+        yield from check_levels(
+            funcstats[key],
+            label=label,
+            metric_name=key,
+            levels_upper=_upper_levels(section, key),
+            render_func=_fmt_duration,
+            notice_only=True,
+        )
+
+
+def _failed(log):
+    # the rule of the aggregated KQL, where toint() of a non numeric
+    # result code is null
+    return not log.success or (
+        isinstance(log.result_code, int) and log.result_code > 399)
+
 
-def _check_http_invocations(funcspec, funclogs):
+def _percentile(values, percent):
+    # nearest rank of sorted values, as Kusto percentile()
+    return values[max(-(-percent * len(values) // 100) - 1, 0)]
+
+
+def _summarize_logs(funclogs):
+    # compute from raw logs the same per-function statistics that the
+    # agent returns in aggregated query mode
     failures = 0
-    duration_accu = 0
+    statuses = {'status_2xx': 0, 'status_4xx': 0, 'status_5xx': 0}
     for log in funclogs:
-        if log.get('success') != 'True' \
-           or int(log.get('resultCode')) > 399:
+        if _failed(log):
             failures += 1
-        duration_accu += float(log.get('duration', 0))
+        if isinstance(log.result_code, int):
+            status = f'status_{log.result_code // 100}xx'
+            if status in statuses:
+                statuses[status] += 1
+    durations = sorted(log.duration for log in funclogs)
 
+    ninvocs = len(funclogs)
+    return {
+        'invocations': ninvocs,
+        'failures': failures,
+        **statuses,
+        'duration_avg': sum(durations) / ninvocs if ninvocs > 0 else 0,
+        'duration_max': durations[-1] if ninvocs > 0 else None,
+        'duration_p50': _percentile(durations, 50) if durations else None,
+        'duration_p95': _percentile(durations, 95) if durations else None,
+        'duration_p99': _percentile(durations, 99) if durations else None,
+        # logs are sorted by timestamp desc, as in aggregated mode
+        'recent': funclogs,
+    }
+
+
+# z of a 95% confidence
+SAMPLE_CONFIDENCE_Z = 1.96
+
+
+def _weighted_percentile(logs, percent, weight):
+    # nearest rank of logs sorted by duration, each counted weight times
+    rank = percent * weight / 100
+    cumulative = 0
+    for log in logs:
+        cumulative += log.weight
+        if cumulative >= rank:
+            return log.duration
+    return logs[-1].duration
+
+
+def _wilson_interval(rate, samples):
+    # confidence interval of a rate observed in samples, still sensible
+    # when the rate is 0 or 1, unlike the normal approximation
+    z2 = SAMPLE_CONFIDENCE_Z ** 2
+    center = (rate + z2 / (2 * samples)) / (1 + z2 / samples)
+    half = SAMPLE_CONFIDENCE_Z / (1 + z2 / samples) * math.sqrt(
+        rate * (1 - rate) / samples + z2 / (4 * samples ** 2))
+    return max(center - half, 0.0), min(center + half, 1.0)
+
+
+def _summarize_sample(funclogs, totals):
+    # in sampled query mode the logs are a random sample of the rows of
+    # the function, each standing for itemCount requests: the
+    # statistics are estimates, scaled up to the requests counted by
+    # App Insights.  The max duration is the one of the sample
+    weight = sum(log.weight for log in funclogs)
+    if not weight:
+        return _summarize_logs(funclogs)
+
+    failed = 0
+    statuses = {'status_2xx': 0, 'status_4xx': 0, 'status_5xx': 0}
+    duration_sum = 0
+    for log in funclogs:
+        if _failed(log):
+            failed += log.weight
+        if isinstance(log.result_code, int):
+            status = f'status_{log.result_code // 100}xx'
+            if status in statuses:
+                statuses[status] += log.weight
+        duration_sum += log.duration * log.weight
+    by_duration = sorted(funclogs, key=lambda log: log.duration)
+
+    scale = totals['items'] / weight
+    # Kish effective sample size of the unequal weights
+    effective = weight ** 2 / sum(log.weight ** 2 for log in funclogs)
+    return {
+        'invocations': totals['items'],
+        'failures': round(failed * scale),
+        **{key: round(count * scale) for key, count in statuses.items()},
+        'duration_avg': duration_sum / weight,
+        'duration_max': by_duration[-1].duration,
+        'duration_p50': _weighted_percentile(by_duration, 50, weight),
+        'duration_p95': _weighted_percentile(by_duration, 95, weight),
+        'duration_p99': _weighted_percentile(by_duration, 99, weight),
+        'recent': funclogs,
+        'sample': {
+            'logs': len(funclogs),
+            'rows': totals['rows'],
+            'failure_rate': _wilson_interval(failed / weight, effective),
+        },
+    }
+
+
+HTTP_STATUS_CLASSES = [
+    ('status_2xx', "2xx"),
+    ('status_4xx', "4xx"),
+    ('status_5xx', "5xx"),
+]
+
+
+def _check_http_invocations(funcspec, funcstats, section):
+    invocations = funcstats['invocations']
     yield from check_levels(
-        failures,
+        funcstats['failures'],
         label="Failures",
         metric_name="failures",
-        levels_upper=("fixed", (1, 2)),
+        levels_upper=_upper_levels(section, 'failures', ("fixed", (1, 2))),
         render_func=lambda v: "%d" % int(v),
     )
 
-    ninvocs = len(funclogs)
-    duration_avg = duration_accu / ninvocs if ninvocs > 0 else 0
-    yield from _check_duration(duration_avg)
+    # rates are relative to the window of the query, unknown to
+    # sections of older agents
+    if section['window']:
+        yield from check_levels(
+            invocations / section['window'],
+            label="Request rate",
+            metric_name="request_rate",
+            levels_upper=_upper_levels(section, 'request_rate'),
+            render_func=lambda v: "%.2f/s" % v,
+            notice_only=True,
+        )
+
+    yield from check_levels(
+        100.0 * funcstats['failures'] / invocations if invocations else 0,
+        label="Failure rate",
+        metric_name="failure_rate",
+        levels_upper=_upper_levels(section, 'failure_rate'),
+        render_func=render.percent,
+    )
 
+    sample = funcstats.get('sample')
+    if sample:
+        low, high = sample['failure_rate']
+        yield Result(
+            state=State.OK,
+            notice=f"Estimated from {sample['logs']} of {sample['rows']} "
+            f"logs, failure rate between {render.percent(100 * low)} and "
+            f"{render.percent(100 * high)} at 95% confidence",
+        )
 
-def _check_scheduled_invocations(funcspec, funclogs):
-    clock_skew_secs = 60
-    delay_warn_secs = 120  # TODO config
-    delay_crit_secs = 240  # TODO config
+    # status classes are missing from sections of older agents
+    if funcstats.get('status_5xx') is not None:
+        yield from check_levels(
+            100.0 * funcstats['status_5xx'] / invocations
+            if invocations else 0,
+            label="Server error rate",
+            metric_name="server_error_rate",
+            levels_upper=_upper_levels(section, 'server_error_rate'),
+            render_func=render.percent,
+            notice_only=True,
+        )
+        for key, label in HTTP_STATUS_CLASSES:
+            yield from check_levels(
+                funcstats[key],
+                label=f"{label} responses",
+                metric_name=f"requests_{label}",
+                render_func=lambda v: "%d" % int(v),
+                notice_only=True,
+            )
 
-    funccron = funcspec['schedule']
-    now = datetime.now(timezone.utc)
-    itr = croniter(funccron, now, second_at_beginning=True)
-    schedule = itr.get_prev(datetime)
-
-    duration_accu = 0
-    nfailures = 0
-    matching_log = None
-    success_log = None
-    for log in funclogs:
-        success = log.get('success') == 'True' and log.get('resultCode') == '0'
-        if not success:
-            nfailures += 1
-        duration_accu += float(log.get('duration', 0))
-        timestamp = datetime.fromisoformat(log['timestamp'])
-        diff_secs = (timestamp - schedule).total_seconds()
-
-        if diff_secs + clock_skew_secs > 0:
-            # execution log is after expected schedule (considering clock skew)
-            if diff_secs < delay_crit_secs:
-                # execution log is considered matching the expected schedule
-                matching_log = log
-            if success:
-                # there is a successful invocation after schedule: we
-                # consider schedule in sync.  this can be different
-                # from the log that matched the schedule, e.g. if
-                # schedule execution failed and then the function was
-                # ran manually
-                success_log = log
+    yield from _check_duration(funcstats, section)
+
+
+#
+# schedule engine: the fire times of a cron expression in the window
+# are expanded once per section and shared by its timer functions, the
+# parsed cron expressions once per process
+#
+
+SCHEDULE_CLOCK_SKEW_SECS = 60
+# default levels of the delay of the last scheduled invocation, in
+# seconds, and of the runs missed in the window: App Insights can
+# ingest a log some minutes late, which must not warn for the whole
+# window.  The critical delay also bounds how late an invocation can
+# follow its fire time
+SCHEDULE_DELAY_LEVELS = ("fixed", (120.0, 240.0))
+SCHEDULE_MISSED_RUNS_LEVELS = ("fixed", (2, 4))
+# fire times expanded per check at most: the window divided by the
+# interval of the schedule, up to this
+SCHEDULE_MAX_FIRE_TIMES = 10000
+# fire times of the schedules by (cron, now), shared by the timer
+# functions checked in the same second
+SCHEDULE_CACHE_SIZE = 64
+
+_compiled_schedules = {}
+_expanded_schedules = {}
+
+
+def _compiled_schedule(cron):
+    if cron not in _compiled_schedules:
+        _compiled_schedules[cron] = croniter(cron, second_at_beginning=True)
+    return _compiled_schedules[cron]
+
+
+def _expand_schedule(cron, start, now):
+    # backwards from now, so that the latest ones are kept when there
+    # are too many.  The shortest of the latest intervals bounds how
+    # many fire times the window holds
+    itr = _compiled_schedule(cron)
+    itr.set_current(now)
+    times = [itr.get_prev(float) for _ in range(3)]
+    interval = max(min(a - b for a, b in zip(times, times[1:])), 1)
+    limit = min(int((now - start) // interval) + 3, SCHEDULE_MAX_FIRE_TIMES)
+    while times[-1] >= start and len(times) < limit:
+        times.append(itr.get_prev(float))
+    times.reverse()
+    return times
+
+
+def _fire_times(cron, start, now, earliest):
+    """Sorted fire times of cron up to now, in epoch seconds, from the
+    last one before start.  They are expanded from earliest, the
+    earliest start of the timer functions of the section, and sliced
+    for each function."""
+    key = (cron, int(now))
+    expanded = _expanded_schedules.get(key)
+    if expanded is None or expanded[0] > start:
+        if len(_expanded_schedules) >= SCHEDULE_CACHE_SIZE:
+            _expanded_schedules.clear()
+        expanded_from = int(min(start, earliest))
+        expanded = (expanded_from,
+                    _expand_schedule(cron, expanded_from, int(now)))
+        _expanded_schedules[key] = expanded
+    times = expanded[1]
+
+    # from the last fire time before start
+    first = max(bisect.bisect_right(times, start) - 1, 0)
+    return times[first:]
+
+
+def _schedule_window_start(section, funcstats, now):
+    # the invocations must cover the window to tell missed runs: only
+    # the most recent ones are known in aggregated and incremental modes
+    recent = funcstats['recent']
+    start = now - section['window'] if section['window'] else None
+    if recent and (start is None or funcstats['invocations'] > len(recent)):
+        oldest = recent[-1].timestamp - SCHEDULE_CLOCK_SKEW_SECS
+        start = oldest if start is None else max(start, oldest)
+    # without invocations nor window, only the last fire time is checked
+    return now if start is None else start
+
+
+def _section_schedule_start(section, start, now):
+    # no timer function of the section starts before the window, only
+    # those of older sections without window need their own expansion
+    return now - section['window'] if section['window'] else start
+
+
+def _match_schedule(fire_times, invocations, max_delay):
+    """Match invocations to fire times in one merge pass of both sorted
+    lists.  An invocation matches the first fire time it follows (up
+    to the clock skew) by less than max_delay, and before the next fire
+    time.  Return the matched invocation for each fire time, or None."""
+    matches = []
+    i = 0
+    for k, fire_time in enumerate(fire_times):
+        end = fire_time + max_delay
+        if k + 1 < len(fire_times):
+            end = min(end, fire_times[k + 1])
+        earliest = fire_time - SCHEDULE_CLOCK_SKEW_SECS
+        # skip invocations not scheduled, e.g. ran manually
+        while i < len(invocations) and invocations[i].timestamp < earliest:
+            i += 1
+        if i < len(invocations) and invocations[i].timestamp < end:
+            matches.append(invocations[i])
+            i += 1
+        else:
+            matches.append(None)
+    return matches
 
+
+def _check_scheduled_invocations(funcspec, funcstats, section):
+    funccron = funcspec['schedule']
+    now = time.time()
+    start = _schedule_window_start(section, funcstats, now)
+    fire_times = _fire_times(funccron, start, now,
+                             _section_schedule_start(section, start, now))
+    # recent invocations are sorted by timestamp desc
+    invocations = funcstats['recent'][::-1]
+    delay_levels = _upper_levels(section, 'schedule_delay',
+                                 SCHEDULE_DELAY_LEVELS)
+    # without levels, an invocation can follow its fire time up to the
+    # next one
+    matches = _match_schedule(
+        fire_times, invocations,
+        delay_levels[1][1] if delay_levels else math.inf)
+
+    def _fmt(epoch):
+        return datetime.fromtimestamp(epoch, timezone.utc)
+
+    schedule = fire_times[-1]
+    matching_log = matches[-1]
+    # the last invocation is pending below the warning delay, when it
+    # may still be ingested: the previous fire time tells the sync
+    pending = matching_log is None and (
+        delay_levels is None or now - schedule < delay_levels[1][0])
+    due = fire_times[-2] if pending and len(fire_times) > 1 else schedule
     if matching_log:
         yield Result(
             state=State.OK,
             summary="Scheduled invocation fired",
             details="Invoked at %s, expected at %s (CRON: %s)" %
-            (matching_log['timestamp'], schedule, funccron),
+            (_fmt(matching_log.timestamp), _fmt(schedule), funccron),
         )
     else:
-        warn = (now - schedule).total_seconds() < delay_warn_secs
+        # not invoked yet, or not ingested yet by App Insights
+        yield from check_levels(
+            now - schedule,
+            label="Scheduled invocation pending",
+            levels_upper=delay_levels,
+            render_func=lambda v: "%.0f s" % v,
+        )
+        yield Result(
+            state=State.OK,
+            notice="Invocation expected at %s (CRON: %s)" %
+            (_fmt(schedule), funccron),
+        )
+
+    # previous fire times in the window, excluded those whose early
+    # invocations could precede the window
+    window = [
+        (fire_time, match)
+        for fire_time, match in zip(fire_times[:-1], matches[:-1])
+        if fire_time - SCHEDULE_CLOCK_SKEW_SECS >= start
+    ]
+    missed = [fire_time for fire_time, match in window if match is None]
+    yield from check_levels(
+        len(missed),
+        label="Missed runs in window",
+        metric_name="missed_runs",
+        levels_upper=_upper_levels(section, 'missed_runs',
+                                   SCHEDULE_MISSED_RUNS_LEVELS),
+        render_func=lambda v: "%d" % int(v),
+    )
+    if missed:
         yield Result(
-            state=State.WARN if warn else State.CRIT,
-            summary="Missed scheduled invocation",
-            details="Invocation expected at %s (CRON: %s)" %
-            (schedule, funccron),
+            state=State.OK,
+            notice="Missed runs expected at %s" %
+            ", ".join(str(_fmt(fire_time)) for fire_time in missed[-10:]),
         )
 
-    if success_log:
+    lateness = [
+        max(match.timestamp - fire_time, 0)
+        for fire_time, match in zip(fire_times, matches)
+        if match is not None and fire_time - SCHEDULE_CLOCK_SKEW_SECS >= start
+    ]
+    if lateness:
+        yield from check_levels(
+            sum(lateness) / len(lateness),
+            label="Average lateness",
+            metric_name="lateness_avg",
+            levels_upper=_upper_levels(section, 'lateness_avg'),
+            render_func=lambda v: "%.1f s" % v,
+            notice_only=True,
+        )
+        yield from check_levels(
+            max(lateness),
+            label="Max lateness",
+            metric_name="lateness_max",
+            levels_upper=_upper_levels(section, 'lateness_max'),
+            render_func=lambda v: "%.1f s" % v,
+            notice_only=True,
+        )
+
+    # a successful invocation after the last due schedule means that the
+    # schedule is in sync.  This can be different from the invocation
+    # matching the schedule, e.g. if it failed and then the function
+    # was ran manually
+    nfailures = sum(
+        1 for log in invocations
+        if not (log.success and log.result_code == 0))
+    in_sync = any(
+        log.success and log.result_code == 0 and
+        log.timestamp + SCHEDULE_CLOCK_SKEW_SECS > due
+        for log in invocations)
+    if in_sync:
         yield Result(
             state=State.OK,
             summary="Schedule in sync",
@@ -156,9 +699,7 @@ def _check_scheduled_invocations(funcspec, funclogs):
             details=f"Schedule out of sync with {nfailures} current failures",
         )
 
-    ninvocs = len(funclogs)
-    duration_avg = duration_accu / ninvocs if ninvocs > 0 else 0
-    yield from _check_duration(duration_avg)
+    yield from _check_duration(funcstats, section)
 
 
 def check_azurefunctions(item, section):
@@ -174,19 +715,35 @@ def check_azurefunctions(item, section):
             return
 
         [appname, funcname] = item.split(" - ")
+        key = (appname, funcname)
+
+        # the agent could not list the functions of the app, or query
+        # its invocations: the other apps are still checked
+        errors = section['errors'].get(appname, []) \
+            + section['errors'].get(None, [])
+        if errors:
+            yield Result(
+                state=State.UNKNOWN,
+                # summaries are single line
+                summary=errors[0].split("\n", 1)[0],
+                details="\n".join(errors),
+            )
+            return
 
-        funcs = section.get('apps', {}).get(appname)
-        func = [func for func in funcs if func['name'] == funcname][0]
+        func = section['funcs'][key]
 
-        funclogs = [
-            log for log in logs if log['cloud_RoleName'] == appname
-            and log['operation_Name'] == funcname
-        ]
+        funcstats = section['stats'].get(key)
+        totals = section['totals'].get(key)
+        if funcstats is None and totals and func['type'] == "httpTrigger":
+            # timer functions are never sampled, see the agent
+            funcstats = _summarize_sample(logs.get(key, []), totals)
+        elif funcstats is None:
+            funcstats = _summarize_logs(logs.get(key, []))
 
         if func['type'] == "timerTrigger":
-            yield from _check_scheduled_invocations(func, funclogs)
+            yield from _check_scheduled_invocations(func, funcstats, section)
         elif func['type'] == "httpTrigger":
-            yield from _check_http_invocations(func, funclogs)
+            yield from _check_http_invocations(func, funcstats, section)
         else:
             yield Result(
                 state=State.UNKNOWN,
@@ -0,0 +1,95 @@
+"""Levels of the Azure agents performance service.
+
+The service is discovered from the azure_agent_perf section, printed
+by agent_azurefunctions and agent_azuremonitor, and checked by
+agent_based/azure_agent_perf.py with the levels configured here.
+
+"""
+
+from cmk.rulesets.v1.form_specs import Dictionary
+from cmk.rulesets.v1.form_specs import DictElement
+from cmk.rulesets.v1.form_specs import Integer
+from cmk.rulesets.v1.form_specs import SimpleLevels
+from cmk.rulesets.v1.form_specs import LevelDirection
+from cmk.rulesets.v1.form_specs import TimeSpan
+from cmk.rulesets.v1.form_specs import TimeMagnitude
+from cmk.rulesets.v1.form_specs import DefaultValue
+from cmk.rulesets.v1.rule_specs import CheckParameters
+from cmk.rulesets.v1.rule_specs import HostAndItemCondition
+from cmk.rulesets.v1.rule_specs import Topic
+from cmk.rulesets.v1.rule_specs import Help
+from cmk.rulesets.v1.rule_specs import Title
+
+
+def _time_levels(title, help_text, prefill):
+    return DictElement(
+        required=False,
+        parameter_form=SimpleLevels(
+            title=title,
+            help_text=help_text,
+            form_spec_template=TimeSpan(
+                displayed_magnitudes=[TimeMagnitude.SECOND],
+            ),
+            level_direction=LevelDirection.UPPER,
+            prefill_fixed_levels=DefaultValue(prefill),
+        ),
+    )
+
+
+def _formspec():
+    return Dictionary(
+        title=Title("Azure agents performance"),
+        help_text=Help("Levels on the time spent by the Azure special "
+                       "agents.  Phase times are summed up over the "
+                       "targets or queries processed concurrently."),
+        elements={
+            "runtime":
+            _time_levels(
+                Title("Runtime"),
+                Help("Total time of the agent run."),
+                (30.0, 50.0),
+            ),
+            "login":
+            _time_levels(
+                Title("Login time"),
+                Help("Time spent to get access tokens from Entra ID, "
+                     "or from the token cache."),
+                (5.0, 10.0),
+            ),
+            "discovery":
+            _time_levels(
+                Title("Discovery time"),
+                Help("Time spent to list function apps and functions "
+                     "in Azure Resource Manager."),
+                (20.0, 40.0),
+            ),
+            "query":
+            _time_levels(
+                Title("Query time"),
+                Help("Time spent waiting for App Insights or Log "
+                     "Analytics query results."),
+                (20.0, 40.0),
+            ),
+            "retries":
+            DictElement(
+                required=False,
+                parameter_form=SimpleLevels(
+                    title=Title("HTTP retries"),
+                    help_text=Help("Requests to Azure retried after a "
+                                   "throttling or transient error."),
+                    form_spec_template=Integer(),
+                    level_direction=LevelDirection.UPPER,
+                    prefill_fixed_levels=DefaultValue((1, 5)),
+                ),
+            ),
+        },
+    )
+
+
+rule_spec_azure_agent_perf = CheckParameters(
+    name="azure_agent_perf",
+    title=Title("Azure agents performance"),
+    topic=Topic.CLOUD,
+    parameter_form=_formspec,
+    condition=HostAndItemCondition(item_title=Title("Agent")),
+)
@@ -13,16 +13,137 @@ server_side_calls/special_agent.py
 
 from cmk.rulesets.v1.form_specs import Dictionary
 from cmk.rulesets.v1.form_specs import DictElement
+from cmk.rulesets.v1.form_specs import Float
 from cmk.rulesets.v1.form_specs import Integer
+from cmk.rulesets.v1.form_specs import LevelDirection
+from cmk.rulesets.v1.form_specs import List
+from cmk.rulesets.v1.form_specs import SimpleLevels
+from cmk.rulesets.v1.form_specs import SingleChoice
+from cmk.rulesets.v1.form_specs import SingleChoiceElement
+from cmk.rulesets.v1.form_specs import DefaultValue
 from cmk.rulesets.v1.form_specs import String
 from cmk.rulesets.v1.form_specs import Password
 from cmk.rulesets.v1.form_specs import migrate_to_password
+from cmk.rulesets.v1.form_specs.validators import NumberInRange
 from cmk.rulesets.v1.rule_specs import SpecialAgent
 from cmk.rulesets.v1.rule_specs import Topic
 from cmk.rulesets.v1.rule_specs import Help
+from cmk.rulesets.v1 import Label
 from cmk.rulesets.v1.rule_specs import Title
 
 
+def _upper_levels(title, unit_symbol, prefill):
+    return DictElement(
+        required=False,
+        parameter_form=SimpleLevels(
+            title=title,
+            form_spec_template=Float(unit_symbol=unit_symbol),
+            level_direction=LevelDirection.UPPER,
+            prefill_fixed_levels=DefaultValue(prefill),
+        ),
+    )
+
+
+def _sharding_formspec():
+    return Dictionary(
+        title=Title("Sharding across collector nodes"),
+        help_text=Help(
+            "Split the function apps of the targets among the "
+            "collector nodes of a distributed CheckMK, e.g. its sites, "
+            "with a consistent hash: configure the same nodes in a rule "
+            "on each node, and each one monitors only its share, sent "
+            "to the target hosts by piggyback.  Adding or removing a "
+            "node moves only about 1/N of the apps"
+        ),
+        elements={
+            "nodes":
+            DictElement(
+                required=True,
+                parameter_form=List(
+                    title=Title("Collector nodes"),
+                    add_element_label=Label("Add node"),
+                    element_template=String(title=Title("Node name")),
+                ),
+            ),
+            "node":
+            DictElement(
+                required=False,
+                parameter_form=String(
+                    title=Title("This node"),
+                    help_text=Help(
+                        "Name of the node running this rule, by default "
+                        "the CheckMK site"),
+                ),
+            ),
+        })
+
+
+def _levels_formspec():
+    return Dictionary(
+        title=Title("Function levels"),
+        help_text=Help("Upper levels applied to every function.  "
+                       "Percentiles are computed by App Insights in "
+                       "aggregated mode, and estimated with a relative "
+                       "error below 2% in incremental mode.  Rates of "
+                       "HTTP functions are relative to the KQL timedelta; "
+                       "without a rule, 1 and 2 failures warn and crit.  "
+                       "Timer functions warn and crit when their last "
+                       "invocation is pending since 120 and 240 seconds, "
+                       "and when 2 and 4 runs are missing in the "
+                       "timedelta"),
+        elements={
+            "duration_avg":
+            _upper_levels(Title("Average duration"), "ms", (1000.0, 2000.0)),
+            "duration_p50":
+            _upper_levels(Title("P50 duration"), "ms", (1000.0, 2000.0)),
+            "duration_p95":
+            _upper_levels(Title("P95 duration"), "ms", (2000.0, 5000.0)),
+            "duration_p99":
+            _upper_levels(Title("P99 duration"), "ms", (5000.0, 10000.0)),
+            "duration_max":
+            _upper_levels(Title("Max duration"), "ms", (10000.0, 30000.0)),
+            "failures":
+            DictElement(
+                required=False,
+                parameter_form=SimpleLevels(
+                    title=Title("Failures of HTTP functions"),
+                    form_spec_template=Integer(),
+                    level_direction=LevelDirection.UPPER,
+                    prefill_fixed_levels=DefaultValue((1, 2)),
+                ),
+            ),
+            "failure_rate":
+            _upper_levels(Title("Failure rate of HTTP functions"), "%",
+                          (1.0, 5.0)),
+            "server_error_rate":
+            _upper_levels(Title("5xx rate of HTTP functions"), "%",
+                          (1.0, 5.0)),
+            "request_rate":
+            _upper_levels(Title("Request rate of HTTP functions"), "/s",
+                          (100.0, 200.0)),
+            "missed_runs":
+            DictElement(
+                required=False,
+                parameter_form=SimpleLevels(
+                    title=Title("Missed runs of timer functions"),
+                    form_spec_template=Integer(),
+                    level_direction=LevelDirection.UPPER,
+                    prefill_fixed_levels=DefaultValue((2, 4)),
+                ),
+            ),
+            "schedule_delay":
+            _upper_levels(Title("Delay of the last timer invocation"), "s",
+                          (120.0, 240.0)),
+            "lateness_avg":
+            _upper_levels(Title("Average lateness of timer functions"), "s",
+                          (60.0, 120.0)),
+            "lateness_max":
+            _upper_levels(Title("Max lateness of timer functions"), "s",
+                          (120.0, 240.0)),
+        },
+    )
+
+
 def _formspec():
     return Dictionary(
         title=Title("Azure Functions checks"),
@@ -90,6 +211,233 @@ def _formspec():
                         "Expressed as KQL expression. Examples: 1d, 8.5h, 9m"),
                 ),
             ),
+            "targets":
+            DictElement(
+                required=False,
+                parameter_form=List(
+                    title=Title("Additional targets (piggyback)"),
+                    help_text=Help(
+                        "Other resource groups to monitor within the same "
+                        "special agent run, sharing login and connections.  "
+                        "Each one is sent by piggyback to its CheckMK host"),
+                    add_element_label=Label("Add target"),
+                    element_template=Dictionary(
+                        elements={
+                            "host":
+                            DictElement(
+                                required=True,
+                                parameter_form=String(
+                                    title=Title("CheckMK host name"),
+                                    help_text=Help(
+                                        "Host receiving the piggyback data"),
+                                ),
+                            ),
+                            "subscription_id":
+                            DictElement(
+                                required=True,
+                                parameter_form=String(
+                                    title=Title("Azure Subscription ID"),
+                                ),
+                            ),
+                            "resource_group":
+                            DictElement(
+                                required=True,
+                                parameter_form=String(
+                                    title=Title("Azure Resource Group"),
+                                ),
+                            ),
+                            "appinsights_app_id":
+                            DictElement(
+                                required=True,
+                                parameter_form=String(
+                                    title=Title("App ID of App Insights"),
+                                ),
+                            ),
+                        },
+                    ),
+                ),
+            ),
+            "max_concurrency":
+            DictElement(
+                required=False,
+                parameter_form=Integer(
+                    title=Title("Maximum concurrent requests"),
+                    help_text=Help(
+                        "Maximum number of concurrent requests to each "
+                        "Azure API (ARM and App Insights) when monitoring "
+                        "multiple targets"),
+                    prefill=DefaultValue(8),
+                ),
+            ),
+            "max_retries":
+            DictElement(
+                required=False,
+                parameter_form=Integer(
+                    title=Title("Maximum retries"),
+                    help_text=Help(
+                        "Retries of a request throttled (HTTP 429) or "
+                        "failed by Azure, after an exponential backoff "
+                        "or the delay asked by Azure"),
+                    prefill=DefaultValue(3),
+                ),
+            ),
+            "request_timeout":
+            DictElement(
+                required=False,
+                parameter_form=Integer(
+                    title=Title("Request timeout (seconds)"),
+                    help_text=Help(
+                        "Seconds to wait for the connection to Azure and "
+                        "for each read of a response"),
+                    prefill=DefaultValue(60),
+                ),
+            ),
+            "timeout":
+            DictElement(
+                required=False,
+                parameter_form=Integer(
+                    title=Title("Agent timeout (seconds)"),
+                    help_text=Help(
+                        "Seconds before the requests still running are "
+                        "aborted, e.g. to stay within the check interval.  "
+                        "The services of the apps not yet queried go "
+                        "UNKNOWN, the others are checked as usual"),
+                    prefill=DefaultValue(50),
+                ),
+            ),
+            "query_mode":
+            DictElement(
+                required=False,
+                parameter_form=SingleChoice(
+                    title=Title("Query mode"),
+                    help_text=Help(
+                        "Raw mode fetches every invocation log in the "
+                        "time delta.  Aggregated mode lets App Insights "
+                        "summarize invocations per function and fetches "
+                        "only the statistics and the most recent "
+                        "invocations, reducing the transferred data on "
+                        "busy function apps.  Incremental mode fetches "
+                        "only the logs since the previous check and "
+                        "keeps the per-function statistics of the time "
+                        "delta in a local state file.  Metrics mode "
+                        "fetches the request metrics pre-aggregated by "
+                        "App Insights for all the apps in one call, and "
+                        "the logs of timer functions only; percentiles "
+                        "of the durations are not available.  Sampled "
+                        "mode fetches a random sample of the logs of each "
+                        "HTTP function, weighted by their itemCount, so "
+                        "that failures and durations are estimated with "
+                        "a stated confidence at a cost independent of the "
+                        "traffic; timer functions are not sampled"),
+                    elements=[
+                        SingleChoiceElement(
+                            name="raw",
+                            title=Title("Raw invocation logs"),
+                        ),
+                        SingleChoiceElement(
+                            name="aggregated",
+                            title=Title("Aggregated per function"),
+                        ),
+                        SingleChoiceElement(
+                            name="incremental",
+                            title=Title("Incremental with local state"),
+                        ),
+                        SingleChoiceElement(
+                            name="metrics",
+                            title=Title("Pre-aggregated metrics"),
+                        ),
+                        SingleChoiceElement(
+                            name="sampled",
+                            title=Title("Sampled invocation logs"),
+                        ),
+                    ],
+                    prefill=DefaultValue("raw"),
+                ),
+            ),
+            "sample_size":
+            DictElement(
+                required=False,
+                parameter_form=Integer(
+                    title=Title("Sampled logs per function"),
+                    help_text=Help(
+                        "In sampled query mode, the number of logs "
+                        "sampled for each HTTP function.  Larger samples "
+                        "narrow the confidence interval of the estimates"),
+                    prefill=DefaultValue(1000),
+                ),
+            ),
+            "recent_invocations":
+            DictElement(
+                required=False,
+                parameter_form=Integer(
+                    title=Title("Recent invocations per function"),
+                    help_text=Help(
+                        "In aggregated and incremental query modes, the "
+                        "number of latest invocations kept for each "
+                        "function.  The schedule of timer functions is "
+                        "checked over the time they span only, so more "
+                        "of them cover more of the time window"),
+                    prefill=DefaultValue(10),
+                    custom_validate=(NumberInRange(min_value=1),),
+                ),
+            ),
+            "levels":
+            DictElement(
+                required=False,
+                parameter_form=_levels_formspec(),
+            ),
+            "query_cache_ttl":
+            DictElement(
+                required=False,
+                parameter_form=Integer(
+                    title=Title("Query cache TTL (seconds)"),
+                    help_text=Help(
+                        "Share for N seconds the result of the App "
+                        "Insights query among the checks of hosts and "
+                        "rules monitoring the same App Insights, e.g. "
+                        "with different resource groups: the first check "
+                        "runs the query, the others reuse its result.  "
+                        "Not used in incremental query mode"),
+                    prefill=DefaultValue(60),
+                ),
+            ),
+            "discovery_cache_ttl":
+            DictElement(
+                required=False,
+                parameter_form=Integer(
+                    title=Title("Discovery cache TTL (seconds)"),
+                    help_text=Help(
+                        "Reuse the function apps discovered in the "
+                        "resource group for N seconds, instead of listing "
+                        "them on every check.  Up to twice this time the "
+                        "cached functions are still used while they are "
+                        "refreshed in background.  Functions found in "
+                        "App Insights but not in the cache force a "
+                        "refresh"),
+                    prefill=DefaultValue(3600),
+                ),
+            ),
+            "collector_interval":
+            DictElement(
+                required=False,
+                parameter_form=Integer(
+                    title=Title("Resident collector interval (seconds)"),
+                    help_text=Help(
+                        "Query Azure every N seconds from a resident "
+                        "collector process, which keeps logins and "
+                        "connections open, and print its cached results "
+                        "on each check.  Results older than twice this "
+                        "time are queried directly.  The collector is "
+                        "started by the first check and stops when "
+                        "checks stop reading its results"),
+                    prefill=DefaultValue(60),
+                ),
+            ),
+            "sharding":
+            DictElement(
+                required=False,
+                parameter_form=_sharding_formspec(),
+            ),
             "proxy":
             DictElement(
                 required=False,
@@ -23,6 +23,59 @@ def _agent_arguments(params, host_config):
         "--timedelta-kql", str(params['timedelta_kql']),
     ]
 
+    for target in params.get('targets', []):
+        args.append("--target")
+        args.append(str(target['host']))
+        args.append(str(target['subscription_id']))
+        args.append(str(target['resource_group']))
+        args.append(str(target['appinsights_app_id']))
+    if params.get('max_concurrency', None):
+        args.append("--max-concurrency")
+        args.append(str(params['max_concurrency']))
+    if params.get('max_retries', None) is not None:
+        args.append("--max-retries")
+        args.append(str(params['max_retries']))
+    if params.get('request_timeout', None):
+        args.append("--request-timeout")
+        args.append(str(params['request_timeout']))
+    if params.get('timeout', None):
+        args.append("--timeout")
+        args.append(str(params['timeout']))
+    if params.get('query_mode', None):
+        args.append("--query-mode")
+        args.append(str(params['query_mode']))
+    if params.get('sample_size', None):
+        args.append("--sample-size")
+        args.append(str(params['sample_size']))
+    if params.get('recent_invocations', None):
+        args.append("--recent-invocations")
+        args.append(str(params['recent_invocations']))
+    for metric, levels in params.get('levels', {}).items():
+        # SimpleLevels are ("fixed", (warn, crit)) or ("no_levels", None)
+        if levels[0] == "fixed":
+            args.append("--levels")
+            args.append(metric)
+            args.append(str(levels[1][0]))
+            args.append(str(levels[1][1]))
+        else:
+            # else the check applies its defaults, if any
+            args.append("--no-levels")
+            args.append(metric)
+    if params.get('query_cache_ttl', None):
+        args.append("--query-cache-ttl")
+        args.append(str(params['query_cache_ttl']))
+    if params.get('discovery_cache_ttl', None):
+        args.append("--discovery-cache-ttl")
+        args.append(str(params['discovery_cache_ttl']))
+    if params.get('collector_interval', None):
+        args.append("--collector-interval")
+        args.append(str(params['collector_interval']))
+    if params.get('sharding', None):
+        args.append("--shard-nodes")
+        args.append(",".join(str(n) for n in params['sharding']['nodes']))
+        if params['sharding'].get('node', None):
+            args.append("--shard-node")
+            args.append(str(params['sharding']['node']))
     if params.get('proxy', None):
         args.append("--proxy")
         args.append(str(params['proxy']))
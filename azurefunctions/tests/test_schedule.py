@@ -0,0 +1,185 @@
+"""Tests of the schedule check of timer functions.
+
+They need the CheckMK libraries, e.g. run them as the site user.
+"""
+
+import importlib.util
+import json
+import os
+import types
+
+import pytest
+
+pytest.importorskip('cmk.agent_based.v2')
+croniter = pytest.importorskip('croniter').croniter
+
+PLUGIN = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'azurefunctions', 'agent_based',
+    'azurefunctions.py')
+
+# on an hour boundary
+HOUR = 1_700_000_000 - 1_700_000_000 % 3600
+WINDOW = 3600
+
+
+@pytest.fixture
+def plugin():
+    spec = importlib.util.spec_from_file_location('azurefunctions', PLUGIN)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _results(plugin, funcstats, cron, levels=None):
+    """Texts and states of the results of the schedule check, and the
+    values of its metrics.  Notices of OK results have no summary, so
+    they are keyed by their details."""
+    results = {}
+    metrics = {}
+    for result in plugin._check_scheduled_invocations(
+            {'schedule': cron}, funcstats,
+            {'window': WINDOW, 'levels': levels or {}}):
+        if isinstance(result, plugin.Result):
+            results[result.summary or result.details] = result.state
+        else:
+            metrics[result.name] = result.value
+    return results, metrics
+
+
+def _check(plugin, monkeypatch, cron, now, delay):
+    """Results of the check of a timer function invoked delay seconds
+    after each fire time of the window, as the raw query returns."""
+    monkeypatch.setattr(plugin, 'time', types.SimpleNamespace(
+        time=lambda: now))
+    itr = croniter(cron, now - WINDOW, second_at_beginning=True)
+    logs = []
+    fire_time = itr.get_next(float)
+    while fire_time + delay <= now:
+        logs.append(plugin.Invocation(fire_time + delay, True, 0, 100.0))
+        fire_time = itr.get_next(float)
+    logs.reverse()
+    return _results(plugin, plugin._summarize_logs(logs), cron)
+
+
+@pytest.mark.parametrize('cron, delay', [
+    ('0 * * * * *', 0),
+    ('0 * * * * *', 2),
+    ('0 * * * * *', 30),
+    ('*/10 * * * * *', 2),
+    ('*/10 * * * * *', 8),
+    ('0 */5 * * * *', 100),
+])
+def test_on_time_invocations(plugin, monkeypatch, cron, delay):
+    results, metrics = _check(plugin, monkeypatch, cron, HOUR + delay + 1,
+                              delay)
+    state = plugin.State.OK
+    assert results['Scheduled invocation fired'] == state
+    assert results['Missed runs in window: 0'] == state
+    assert results[f'Average lateness: {delay:.1f} s'] == state
+    assert results[f'Max lateness: {delay:.1f} s'] == state
+    assert metrics['missed_runs'] == 0
+    assert metrics['lateness_avg'] == pytest.approx(delay)
+    assert metrics['lateness_max'] == pytest.approx(delay)
+
+
+@pytest.mark.parametrize('levels, state', [
+    # one missed run is tolerated by default
+    (None, 'OK'),
+    ({'missed_runs': [1, 3]}, 'WARN'),
+])
+def test_missed_run(plugin, monkeypatch, levels, state):
+    monkeypatch.setattr(plugin, 'time', types.SimpleNamespace(
+        time=lambda: HOUR + 3))
+    # every minute of the window, but 10 minutes ago
+    logs = [
+        plugin.Invocation(HOUR - 60 * minute + 2, True, 0, 100.0)
+        for minute in range(60) if minute != 10
+    ]
+    results, metrics = _results(
+        plugin, plugin._summarize_logs(logs), '0 * * * * *', levels)
+    assert metrics['missed_runs'] == 1
+    assert [
+        result_state for text, result_state in results.items()
+        if text.startswith('Missed runs in window: 1')
+    ] == [plugin.State[state]]
+
+
+@pytest.mark.parametrize('pending, state', [
+    # the last invocation may still be ingested
+    (30, 'OK'),
+    (150, 'WARN'),
+    (300, 'CRIT'),
+])
+def test_pending_invocation(plugin, monkeypatch, pending, state):
+    now = HOUR + pending
+    monkeypatch.setattr(plugin, 'time', types.SimpleNamespace(
+        time=lambda: now))
+    # every 10 minutes of the window but the last, at HOUR
+    logs = [
+        plugin.Invocation(HOUR - 600 * run + 2, True, 0, 100.0)
+        for run in range(1, 7)
+    ]
+    results, _ = _results(
+        plugin, plugin._summarize_logs(logs), '0 */10 * * * *')
+    assert [
+        result_state for text, result_state in results.items()
+        if text.startswith(f'Scheduled invocation pending: {pending} s')
+    ] == [plugin.State[state]]
+    in_sync = 'Schedule in sync' if state == 'OK' else 'Schedule out of sync'
+    assert in_sync in results
+
+
+def test_schedule_expanded_once_per_section(plugin, monkeypatch):
+    now = HOUR + 3
+    monkeypatch.setattr(plugin, 'time', types.SimpleNamespace(
+        time=lambda: now))
+    expansions = []
+    expand = plugin._expand_schedule
+    monkeypatch.setattr(plugin, '_expand_schedule', lambda *a: (
+        expansions.append(a), expand(*a))[1])
+    # aggregated statistics of two functions, whose recent invocations
+    # start at different times of the window
+    for minutes in [10, 20]:
+        recent = [
+            plugin.Invocation(now - 60 * minute - 1, True, 0, 100.0)
+            for minute in range(minutes)
+        ]
+        funcstats = plugin._summarize_logs(recent)
+        funcstats['invocations'] = 60
+        results, _ = _results(plugin, funcstats, '0 * * * * *')
+        assert results['Missed runs in window: 0'] == plugin.State.OK
+    assert len(expansions) == 1
+
+
+def test_recent_invocations_in_any_order(plugin, monkeypatch):
+    # the aggregated query returns the recent invocations unordered
+    now = HOUR + 3
+    monkeypatch.setattr(plugin, 'time', types.SimpleNamespace(
+        time=lambda: now))
+    recent = [[HOUR - 60 * minute + 2, True, 0, 100.0]
+              for minute in range(10)]
+    recent = recent[1::2] + recent[::2]
+    header = {
+        'version': 2,
+        'columns': {
+            'l': [], 'e': [], 'w': [], 't': [],
+            's': ['cloud_RoleName', 'operation_Name', 'invocations',
+                  'duration_avg', 'recent'],
+            'i': ['timestamp', 'success', 'resultCode', 'duration'],
+        },
+        'window': WINDOW,
+        'levels': {},
+    }
+    apps = {'app': [{'name': 'timer', 'type': 'timerTrigger',
+                     'schedule': '0 * * * * *'}]}
+    section = plugin.parse_azurefunctions([
+        [json.dumps(header)],
+        [json.dumps(apps)],
+        [json.dumps(['s', 'app', 'timer', 60, 100.0, recent])],
+    ])
+    funcstats = section['stats'][('app', 'timer')]
+    assert [log.timestamp for log in funcstats['recent']] == \
+        sorted((inv[0] for inv in recent), reverse=True)
+    results, metrics = _results(plugin, funcstats, '0 * * * * *')
+    assert results['Scheduled invocation fired'] == plugin.State.OK
+    assert metrics['missed_runs'] == 0
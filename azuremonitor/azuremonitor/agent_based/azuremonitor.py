@@ -5,73 +5,175 @@ from cmk.agent_based.v2 import CheckPlugin
 from cmk.agent_based.v2 import Service
 from cmk.agent_based.v2 import Result
 from cmk.agent_based.v2 import State
+from cmk.agent_based.v2 import check_levels
 from cmk.utils import debug
 from pprint import pprint
+import json
 import traceback
 from itertools import chain
 
 
+# name of the query configured without a name: its service is named as
+# the single service of the plugin before named queries were added
+DEFAULT_QUERY_NAME = 'logs and metrics'
+
+
+def _safe_parse_int(s, default=0):
+    try:
+        return int(s)
+    except Exception:
+        return default
+
+
+def _parse_legacy(input_list):
+    # output of the agent before named queries: warn and crit counts
+    # followed by one json log per line
+    return {
+        DEFAULT_QUERY_NAME: {
+            'logs': [json.loads(log) for log in input_list[2:]],
+            'count': len(input_list) - 2,
+            'count_warn': _safe_parse_int(input_list[0], 1),
+            'count_crit': _safe_parse_int(input_list[1], 1),
+            'series': None,
+            'error': None,
+            'details': None,
+        },
+    }
+
+
 def parse_azuremonitor(string_table):
     # string_table is a list of lists, each inner list is one line of
-    # the stdout in ../libexec/agent_azuremonitor
-
-    def _safe_parse_int(s, default=0):
-        try:
-            return int(s)
-        except Exception:
-            return default
+    # the stdout in ../libexec/agent_azuremonitor, that is a json
+    # object per query
 
     try:
         # flatten the list because it has every element wrapped in another list
         input_list = list(chain.from_iterable(string_table))
 
-        count_warn_str = input_list[0]
-        count_crit_str = input_list[1]
-        logs = input_list[2:]
-
-        parsed = {
-            'logs': logs,
-            'count_warn': _safe_parse_int(count_warn_str, 1),
-            'count_crit': _safe_parse_int(count_crit_str, 1),
-            'error': None,
-        }
+        if input_list and not input_list[0].startswith('{'):
+            parsed = _parse_legacy(input_list)
+        else:
+            parsed = {}
+            for line in input_list:
+                result = json.loads(line)
+                parsed[result['name']] = {
+                    'logs': result['logs'],
+                    # logs can be just a sample when the agent counts
+                    'count': result.get('count', len(result['logs'])),
+                    'count_warn': _safe_parse_int(result['count_warn'], 1),
+                    'count_crit': _safe_parse_int(result['count_crit'], 1),
+                    # bucket counts, missing from older agents
+                    'series': result.get('series'),
+                    'error': result['error'],
+                    'details': None,
+                }
 
         if debug.enabled():
             pprint(string_table)
             pprint(parsed)
     except Exception as e:
         parsed = {
-            'logs': [f'parsing failed: {e}'],
-            'count_warn': 0,
-            'count_crit': 0,
-            'error': traceback.format_exc(),
+            DEFAULT_QUERY_NAME: {
+                'logs': [],
+                'count': 0,
+                'count_warn': 0,
+                'count_crit': 0,
+                'series': None,
+                'error': f'parsing failed: {e}',
+                'details': traceback.format_exc(),
+            },
         }
 
     return parsed
 
 
 def discover_azuremonitor(section):
-    yield Service()
+    # yield one service per query
+    for name in section:
+        yield Service(item=name)
+
+
+def _series_levels(series, metric):
+    levels = series['levels'].get(metric)
+    return ("fixed", tuple(levels)) if levels else None
+
+
+def _bucket_rates(series):
+    # logs per minute of each bucket; the last one can be shorter than
+    # the others when the window is not a multiple of the bucket size,
+    # and is dropped below half a bucket: scaling its few logs up to a
+    # whole minute would skew the trend
+    bucket_secs = series['bucket_seconds']
+    counts = series['counts']
+    last_secs = series['window_seconds'] - (len(counts) - 1) * bucket_secs
+    rates = [60.0 * count / bucket_secs for count in counts[:-1]]
+    if last_secs >= bucket_secs / 2:
+        rates.append(60.0 * counts[-1] / last_secs)
+    return rates
+
+
+def _slope(rates, bucket_secs):
+    # least squares trend of the bucket rates, per hour
+    n = len(rates)
+    mean_x = (n - 1) / 2
+    mean_y = sum(rates) / n
+    num = sum((x - mean_x) * (y - mean_y) for x, y in enumerate(rates))
+    den = sum((x - mean_x) ** 2 for x in range(n))
+    return num / den * 3600 / bucket_secs
+
+
+def _check_series(series):
+    yield from check_levels(
+        60.0 * sum(series['counts']) / series['window_seconds'],
+        label="Rate",
+        metric_name="log_rate",
+        levels_upper=_series_levels(series, 'rate'),
+        render_func=lambda v: "%.2f/min" % v,
+    )
+    yield from check_levels(
+        max(series['counts']),
+        label="Peak bucket",
+        metric_name="log_peak",
+        levels_upper=_series_levels(series, 'peak'),
+        render_func=lambda v: "%d logs in %d s" % (
+            int(v), series['bucket_seconds']),
+    )
+    rates = _bucket_rates(series)
+    if len(rates) > 1:
+        yield from check_levels(
+            _slope(rates, series['bucket_seconds']),
+            label="Trend",
+            metric_name="log_slope",
+            levels_upper=_series_levels(series, 'slope'),
+            render_func=lambda v: "%+.2f/min per hour" % v,
+        )
 
 
-def check_azuremonitor(section):
+def check_azuremonitor(item, section):
     try:
-        logs = section['logs']
-        count_warn = section['count_warn']
-        count_crit = section['count_crit']
+        query = section.get(item)
+        if query is None:
+            return
 
-        numlogs = len(logs)
+        logs = query['logs']
+        count_warn = query['count_warn']
+        count_crit = query['count_crit']
+
+        numlogs = query['count']
         logs_summary = f"Query retrieved {numlogs} logs"
+        if len(logs) < numlogs and not query['series']:
+            logs_summary += f" (showing {len(logs)})"
 
-        if section['error']:
+        if query['error']:
             yield Result(
                 state=State.UNKNOWN,
-                summary=logs,
-                details=section['error'],
+                summary=query['error'],
+                details=query['details'] or query['error'],
             )
             return
 
-        log_str = '\n'.join(logs) if logs else None
+        log_str = '\n'.join(
+            json.dumps(log, default=str) for log in logs) if logs else None
 
         if numlogs >= count_crit:
             state = State.CRIT
@@ -81,6 +183,9 @@ def check_azuremonitor(section):
             state = State.OK
 
         yield Result(state=state, summary=logs_summary, details=log_str)
+
+        if query['series'] and query['series']['counts']:
+            yield from _check_series(query['series'])
     except Exception as e:
         yield Result(
             state=State.UNKNOWN,
@@ -96,7 +201,7 @@ agent_section_azuremonitor = AgentSection(
 
 check_plugin_myhostgroups = CheckPlugin(
     name="azuremonitor",
-    service_name="Azure Monitor logs and metrics",
+    service_name="Azure Monitor %s",
     discovery_function=discover_azuremonitor,
     check_function=check_azuremonitor,
 )
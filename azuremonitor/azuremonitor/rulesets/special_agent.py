@@ -13,18 +13,194 @@ server_side_calls/special_agent.py
 
 from cmk.rulesets.v1.form_specs import Dictionary
 from cmk.rulesets.v1.form_specs import DictElement
+from cmk.rulesets.v1.form_specs import Float
+from cmk.rulesets.v1.form_specs import LevelDirection
 from cmk.rulesets.v1.form_specs import MultilineText
 from cmk.rulesets.v1.form_specs import Integer
+from cmk.rulesets.v1.form_specs import List
+from cmk.rulesets.v1.form_specs import SimpleLevels
 from cmk.rulesets.v1.form_specs import String
 from cmk.rulesets.v1.form_specs import DefaultValue
 from cmk.rulesets.v1.form_specs import Password
 from cmk.rulesets.v1.form_specs import migrate_to_password
+from cmk.rulesets.v1.form_specs.validators import NumberInRange
+from cmk.rulesets.v1 import Label
 from cmk.rulesets.v1.rule_specs import SpecialAgent
 from cmk.rulesets.v1.rule_specs import Topic
 from cmk.rulesets.v1.rule_specs import Help
 from cmk.rulesets.v1.rule_specs import Title
 
 
+def _sample_rows_formspec():
+    return Integer(
+        title=Title("Count only, with a sample of N logs"),
+        help_text=Help(
+            "Let Azure Monitor count the logs and return only "
+            "N of them as examples, instead of every log.  "
+            "Use 0 to return the count only"
+        ),
+        prefill=DefaultValue(10),
+    )
+
+
+def _series_levels(title, form_spec, prefill):
+    return DictElement(
+        required=False,
+        parameter_form=SimpleLevels(
+            title=title,
+            form_spec_template=form_spec,
+            level_direction=LevelDirection.UPPER,
+            prefill_fixed_levels=DefaultValue(prefill),
+        ),
+    )
+
+
+def _series_formspec():
+    return Dictionary(
+        title=Title("Bucketed series"),
+        help_text=Help(
+            "Let Azure Monitor count the logs in buckets of N seconds, "
+            "with summarize count() by bin(TimeGenerated, N), and "
+            "return only the counts, instead of every log.  The query "
+            "must keep the TimeGenerated column.  The count thresholds "
+            "apply to the total, while rate, peak bucket and trend "
+            "tell a burst from a steady trickle"
+        ),
+        elements={
+            "bucket_seconds":
+            DictElement(
+                required=True,
+                parameter_form=Integer(
+                    title=Title("Bucket size (seconds)"),
+                    prefill=DefaultValue(60),
+                    custom_validate=(NumberInRange(min_value=1),),
+                ),
+            ),
+            "rate": _series_levels(
+                Title("Upper levels on the rate"),
+                Float(unit_symbol="/min"),
+                (10.0, 20.0),
+            ),
+            "peak": _series_levels(
+                Title("Upper levels on the logs of the peak bucket"),
+                Integer(),
+                (10, 20),
+            ),
+            "slope": _series_levels(
+                Title("Upper levels on the trend of the rate"),
+                Float(unit_symbol="/min per hour"),
+                (5.0, 10.0),
+            ),
+        })
+
+
+def _sharding_formspec():
+    return Dictionary(
+        title=Title("Sharding across collector nodes"),
+        help_text=Help(
+            "Split the queries, by resource ID, among the collector "
+            "nodes of a distributed CheckMK, e.g. its sites, with a "
+            "consistent hash: configure the same nodes in a rule on "
+            "each node, and each one runs only its share.  Set a "
+            "piggyback host to collect the results of all the nodes on "
+            "one host.  Adding or removing a node moves only about 1/N "
+            "of the resources"
+        ),
+        elements={
+            "nodes":
+            DictElement(
+                required=True,
+                parameter_form=List(
+                    title=Title("Collector nodes"),
+                    add_element_label=Label("Add node"),
+                    element_template=String(title=Title("Node name")),
+                ),
+            ),
+            "node":
+            DictElement(
+                required=False,
+                parameter_form=String(
+                    title=Title("This node"),
+                    help_text=Help(
+                        "Name of the node running this rule, by default "
+                        "the CheckMK site"),
+                ),
+            ),
+        })
+
+
+def _named_query_formspec():
+    return Dictionary(
+        elements={
+            "name":
+            DictElement(
+                required=True,
+                parameter_form=String(
+                    title=Title("Name"),
+                    help_text=Help(
+                        "Name of the query, used as item of its service"
+                    ),
+                ),
+            ),
+            "resource_id":
+            DictElement(
+                required=True,
+                parameter_form=String(
+                    title=Title("Resource ID"),
+                    help_text=Help("ID of the target Azure resource"),
+                ),
+            ),
+            "query":
+            DictElement(
+                required=True,
+                parameter_form=MultilineText(
+                    title=Title("KQL query"),
+                    help_text=Help(
+                        "Query to execute to Azure Monitor in KQL "
+                        "(Kusto Query Language) syntax"
+                    ),
+                    monospaced=True,
+                ),
+            ),
+            "timedelta_seconds":
+            DictElement(
+                required=True,
+                parameter_form=Integer(
+                    title=Title("Time delta (seconds)"),
+                    help_text=Help(
+                        "Fetch logs not older than N seconds. "
+                        "Match this to the refresh time of the check"
+                    ),
+                    prefill=DefaultValue(60),
+                ),
+            ),
+            "count_crit":
+            DictElement(
+                required=False,
+                parameter_form=Integer(
+                    title=Title("Critical count threshold"),
+                ),
+            ),
+            "count_warn":
+            DictElement(
+                required=False,
+                parameter_form=Integer(
+                    title=Title("Warning count threshold"),
+                ),
+            ),
+            "sample_rows":
+            DictElement(
+                required=False,
+                parameter_form=_sample_rows_formspec(),
+            ),
+            "series":
+            DictElement(
+                required=False,
+                parameter_form=_series_formspec(),
+            ),
+        })
+
+
 def _formspec():
     return Dictionary(
         title=Title("Azure Monitor logs and metrics"),
@@ -62,7 +238,7 @@ def _formspec():
             ),
             "resource_id":
             DictElement(
-                required=True,
+                required=False,
                 parameter_form=String(
                     title=Title("Resource ID"),
                     help_text=Help("ID of the target Azure resource"),
@@ -70,7 +246,7 @@ def _formspec():
             ),
             "query":
             DictElement(
-                required=True,
+                required=False,
                 parameter_form=MultilineText(
                     title=Title("KQL query"),
                     help_text=Help(
@@ -82,7 +258,7 @@ def _formspec():
             ),
             "timedelta_seconds":
             DictElement(
-                required=True,
+                required=False,
                 parameter_form=Integer(
                     title=Title("Time delta (seconds)"),
                     help_text=Help(
@@ -114,6 +290,87 @@ def _formspec():
                     ),
                 ),
             ),
+            "sample_rows":
+            DictElement(
+                required=False,
+                parameter_form=_sample_rows_formspec(),
+            ),
+            "series":
+            DictElement(
+                required=False,
+                parameter_form=_series_formspec(),
+            ),
+            "queries":
+            DictElement(
+                required=False,
+                parameter_form=List(
+                    title=Title("Named queries"),
+                    help_text=Help(
+                        "Additional queries, executed concurrently in the "
+                        "same special agent run.  Each one results in its "
+                        "own service"
+                    ),
+                    add_element_label=Label("Add query"),
+                    element_template=_named_query_formspec(),
+                ),
+            ),
+            "max_concurrency":
+            DictElement(
+                required=False,
+                parameter_form=Integer(
+                    title=Title("Maximum concurrent queries"),
+                    prefill=DefaultValue(8),
+                ),
+            ),
+            "max_retries":
+            DictElement(
+                required=False,
+                parameter_form=Integer(
+                    title=Title("Maximum retries"),
+                    help_text=Help(
+                        "Retries of a query throttled (HTTP 429) or "
+                        "failed by Azure, after an exponential backoff "
+                        "or the delay asked by Azure"),
+                    prefill=DefaultValue(3),
+                ),
+            ),
+            "request_timeout":
+            DictElement(
+                required=False,
+                parameter_form=Integer(
+                    title=Title("Request timeout (seconds)"),
+                    help_text=Help(
+                        "Seconds to wait for the connection to Azure and "
+                        "for each read of a response"),
+                    prefill=DefaultValue(60),
+                ),
+            ),
+            "timeout":
+            DictElement(
+                required=False,
+                parameter_form=Integer(
+                    title=Title("Agent timeout (seconds)"),
+                    help_text=Help(
+                        "Seconds before the queries still running are "
+                        "aborted and reported as failed"),
+                    prefill=DefaultValue(50),
+                ),
+            ),
+            "sharding":
+            DictElement(
+                required=False,
+                parameter_form=_sharding_formspec(),
+            ),
+            "piggyback_host":
+            DictElement(
+                required=False,
+                parameter_form=String(
+                    title=Title("Piggyback host"),
+                    help_text=Help(
+                        "Send the results of the queries to this host by "
+                        "piggyback, instead of the host of the rule"),
+                ),
+            ),
             "proxy":
             DictElement(
                 required=False,
@@ -7,18 +7,27 @@ are taken from 'params', that are those configured in the gui via the
 rulesets/special_agent.py.
 
 """
+import json
+
 from cmk.server_side_calls.v1 import noop_parser
 from cmk.server_side_calls.v1 import SpecialAgentConfig
 from cmk.server_side_calls.v1 import SpecialAgentCommand
 
 
+def _series_levels(series):
+    # SimpleLevels are ("fixed", (warn, crit)) or ("no_levels", None)
+    return {
+        metric: list(series[metric][1])
+        for metric in ("rate", "peak", "slope")
+        if series.get(metric, ("no_levels", None))[0] == "fixed"
+    }
+
+
 def _agent_arguments(params, host_config):
     args = [
         "--tenant-id", str(params['tenant_id']),
         "--client-id", str(params['client_id']),
         "--client-secret", params['client_secret'].unsafe(),
-        "--resource-id", str(params['resource_id']),
-        "--timedelta-seconds", str(params['timedelta_seconds']),
     ]
 
     if params.get('count_crit', None):
@@ -27,9 +36,68 @@ def _agent_arguments(params, host_config):
     if params.get('count_warn', None):
         args.append("--count-warn")
         args.append(str(params['count_warn']))
+    if params.get('sample_rows', None) is not None:
+        args.append("--sample-rows")
+        args.append(str(params['sample_rows']))
+    if params.get('series', None):
+        args.append("--bucket-seconds")
+        args.append(str(params['series']['bucket_seconds']))
+        for metric, levels in _series_levels(params['series']).items():
+            args.append("--series-levels")
+            args.append(metric)
+            args.append(str(levels[0]))
+            args.append(str(levels[1]))
+    if params.get('sharding', None):
+        args.append("--shard-nodes")
+        args.append(",".join(str(n) for n in params['sharding']['nodes']))
+        if params['sharding'].get('node', None):
+            args.append("--shard-node")
+            args.append(str(params['sharding']['node']))
+    if params.get('piggyback_host', None):
+        args.append("--piggyback-host")
+        args.append(str(params['piggyback_host']))
     if params.get('proxy', None):
         args.append("--proxy")
         args.append(str(params['proxy']))
+    if params.get('max_concurrency', None):
+        args.append("--max-concurrency")
+        args.append(str(params['max_concurrency']))
+    if params.get('max_retries', None) is not None:
+        args.append("--max-retries")
+        args.append(str(params['max_retries']))
+    if params.get('request_timeout', None):
+        args.append("--request-timeout")
+        args.append(str(params['request_timeout']))
+    if params.get('timeout', None):
+        args.append("--timeout")
+        args.append(str(params['timeout']))
+    if params.get('queries', None):
+        # json escapes newlines, so the placeholder below is not needed
+        args.append("--queries")
+        args.append(json.dumps([
+            {
+                "name": str(query['name']),
+                "resource_id": str(query['resource_id']),
+                "query": str(query['query']),
+                "timedelta_seconds": int(query['timedelta_seconds']),
+                "count_warn": int(query.get('count_warn', 0)),
+                "count_crit": int(query.get('count_crit', 1)),
+                "sample_rows": query.get('sample_rows', None),
+                "series": {
+                    "bucket_seconds": int(query['series']['bucket_seconds']),
+                    "levels": _series_levels(query['series']),
+                } if query.get('series', None) else None,
+            } for query in params['queries']
+        ]))
+
+    if not params.get('query', None):
+        yield SpecialAgentCommand(command_arguments=args)
+        return
+
+    args.append("--resource-id")
+    args.append(str(params['resource_id']))
+    args.append("--timedelta-seconds")
+    args.append(str(params['timedelta_seconds']))
 
     # WARNING: MultilineText (--query arg) causes bugs and pains.
     # Here's what I have learned:
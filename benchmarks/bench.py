@@ -0,0 +1,347 @@
+"""Benchmark the special agents and check plugins against fake Azure.
+
+Each scenario runs a special agent as a subprocess, pointed at the
+fake endpoints of fake_azure.py, and records its wall time, peak
+resident memory and output size. When the CheckMK libraries are
+importable (e.g. when run as the site user) the parse and check
+functions of the plugins are timed too on the produced sections.
+
+No Azure account is needed: a token for the fake endpoints is
+written in the agents' encrypted token cache before the runs, so no
+login is ever attempted.
+"""
+
+import argparse
+import base64
+import hashlib
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+import fake_azure
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AGENT_AZUREFUNCTIONS = os.path.join(
+    REPO, 'azurefunctions', 'azurefunctions', 'libexec',
+    'agent_azurefunctions')
+AGENT_AZUREMONITOR = os.path.join(
+    REPO, 'azuremonitor', 'azuremonitor', 'libexec', 'agent_azuremonitor')
+PLUGIN_AZUREFUNCTIONS = os.path.join(
+    REPO, 'azurefunctions', 'azurefunctions', 'agent_based',
+    'azurefunctions.py')
+PLUGIN_AZUREMONITOR = os.path.join(
+    REPO, 'azuremonitor', 'azuremonitor', 'agent_based', 'azuremonitor.py')
+
+TENANT_ID = 'bench-tenant'
+CLIENT_ID = 'bench-client'
+CLIENT_SECRET = 'bench-secret'
+SUBSCRIPTION_ID = '00000000-0000-0000-0000-000000000000'
+RESOURCE_GROUP = 'bench-rg'
+APPINSIGHTS_APP_ID = 'bench-appinsights'
+RESOURCE_ID = (f'/subscriptions/{SUBSCRIPTION_ID}/resourceGroups/'
+               f'{RESOURCE_GROUP}/providers/Microsoft.Insights/'
+               'components/bench')
+
+
+#
+# environment
+#
+
+def write_token_cache(omd_root, scope):
+    """Cache a token for scope the way the agents' CachedTokenCredential
+    does, so that they never try to log in."""
+    cache_dir = os.path.join(omd_root, 'tmp', 'check_mk', 'azure_token_cache')
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    key = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b'checkmk-azure-token-cache',
+    ).derive(CLIENT_SECRET.encode())
+    name = hashlib.sha256(
+        ' '.join([TENANT_ID, CLIENT_ID, scope]).encode()).hexdigest()
+    content = json.dumps({'token': 'bench-token',
+                          'expires_on': int(time.time()) + 86400})
+    with open(os.path.join(cache_dir, name), 'wb') as f:
+        f.write(Fernet(base64.urlsafe_b64encode(key)).encrypt(
+            content.encode()))
+
+
+def agent_env(omd_root, certfile):
+    env = dict(os.environ)
+    env['OMD_ROOT'] = omd_root
+    env['SSL_CERT_FILE'] = certfile
+    env['REQUESTS_CA_BUNDLE'] = certfile
+    for var in ('HTTP_PROXY', 'HTTPS_PROXY', 'http_proxy', 'https_proxy'):
+        env.pop(var, None)
+    return env
+
+
+#
+# scenarios
+#
+
+def azurefunctions_args(base_url, *extra):
+    return [
+        sys.executable, AGENT_AZUREFUNCTIONS,
+        '--tenant-id', TENANT_ID,
+        '--client-id', CLIENT_ID,
+        '--client-secret', CLIENT_SECRET,
+        '--subscription-id', SUBSCRIPTION_ID,
+        '--resource-group', RESOURCE_GROUP,
+        '--appinsights-app-id', APPINSIGHTS_APP_ID,
+        '--timedelta-kql', '1h',
+        '--arm-endpoint', base_url,
+        '--appinsights-endpoint', base_url,
+        *extra,
+    ]
+
+
+def azuremonitor_args(base_url, *extra):
+    return [
+        sys.executable, AGENT_AZUREMONITOR,
+        '--tenant-id', TENANT_ID,
+        '--client-id', CLIENT_ID,
+        '--client-secret', CLIENT_SECRET,
+        '--resource-id', RESOURCE_ID,
+        '--timedelta-seconds', '3600',
+        '--query', 'AppTraces | where SeverityLevel > 2',
+        '--logs-endpoint', base_url,
+        *extra,
+    ]
+
+
+def scenarios(base_url):
+    """Return (name, command, setup) tuples; setup(omd_root) runs before
+    each repetition, out of the measured time."""
+
+    def clean_state(omd_root):
+        state_dir = os.path.join(omd_root, 'tmp', 'check_mk',
+                                 'agent_azurefunctions')
+        for name in os.listdir(state_dir) if os.path.isdir(state_dir) \
+                else []:
+            os.unlink(os.path.join(state_dir, name))
+
+    def keep_state(omd_root):
+        pass
+
+    return [
+        ('azurefunctions raw',
+         azurefunctions_args(base_url, '--query-mode', 'raw'),
+         clean_state),
+        ('azurefunctions aggregated',
+         azurefunctions_args(base_url, '--query-mode', 'aggregated'),
+         clean_state),
+        ('azurefunctions incremental (cold)',
+         azurefunctions_args(base_url, '--query-mode', 'incremental'),
+         clean_state),
+        ('azurefunctions metrics',
+         azurefunctions_args(base_url, '--query-mode', 'metrics'),
+         clean_state),
+        ('azurefunctions sampled',
+         azurefunctions_args(base_url, '--query-mode', 'sampled',
+                             '--sample-size', '10'),
+         clean_state),
+        ('azurefunctions incremental (warm)',
+         azurefunctions_args(base_url, '--query-mode', 'incremental',
+                             '--discovery-cache-ttl', '3600'),
+         keep_state),
+        ('azuremonitor logs',
+         azuremonitor_args(base_url),
+         keep_state),
+        ('azuremonitor count',
+         azuremonitor_args(base_url, '--sample-rows', '10'),
+         keep_state),
+        ('azuremonitor series',
+         azuremonitor_args(base_url, '--bucket-seconds', '60'),
+         keep_state),
+    ]
+
+
+def run_agent(command, env):
+    """Run the agent once, return (output, wall secs, peak rss KiB,
+    stderr)."""
+    with tempfile.TemporaryFile() as out:
+        start = time.perf_counter()
+        proc = subprocess.Popen(command, stdout=out,
+                                stderr=subprocess.PIPE, env=env)
+        stderr = proc.stderr.read()
+        _, status, rusage = os.wait4(proc.pid, 0)
+        elapsed = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        if proc.returncode != 0:
+            raise RuntimeError(
+                f'{command[1]} exited with {proc.returncode}: '
+                f'{stderr.decode(errors="replace")}')
+        out.seek(0)
+        return (out.read().decode(), elapsed, rusage.ru_maxrss,
+                stderr.decode(errors='replace'))
+
+
+#
+# check plugins
+#
+
+def load_plugin(path):
+    """Import a check plugin, or return None without the CheckMK
+    libraries."""
+    try:
+        spec = importlib.util.spec_from_file_location(
+            os.path.basename(path)[:-3], path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    except ImportError:
+        return None
+
+
+def string_table(output, section):
+    """Lines of the first occurrence of section, like sep(0)."""
+    lines = []
+    inside = False
+    for line in output.splitlines():
+        if line.startswith('<<<'):
+            if inside:
+                break
+            inside = line.startswith(f'<<<{section}')
+            continue
+        if inside:
+            lines.append([line])
+    return lines
+
+
+def time_calls(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def bench_plugins(outputs, repeat):
+    results = []
+    azurefunctions = load_plugin(PLUGIN_AZUREFUNCTIONS)
+    azuremonitor = load_plugin(PLUGIN_AZUREMONITOR)
+    if azurefunctions is None or azuremonitor is None:
+        print('CheckMK libraries not found, skipping check plugins',
+              file=sys.stderr)
+        return results
+
+    for name, output in outputs.items():
+        if name.startswith('azurefunctions'):
+            module, section_name = azurefunctions, 'azurefunctions'
+            parse = module.parse_azurefunctions
+            discover = module.discover_azurefunctions
+            check = module.check_azurefunctions
+        else:
+            module, section_name = azuremonitor, 'azuremonitor'
+            parse = module.parse_azuremonitor
+            discover = module.discover_azuremonitor
+            check = module.check_azuremonitor
+
+        table = string_table(output, section_name)
+        section = parse(table)
+        items = [service.item for service in discover(section)]
+
+        def check_all():
+            for item in items:
+                list(check(item, section))
+
+        results.append((f'{name}: parse', time_calls(
+            lambda: parse(table), repeat)))
+        results.append((f'{name}: check {len(items)} services',
+                        time_calls(check_all, repeat)))
+    return results
+
+
+#
+# main
+#
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--apps', type=int, default=5)
+    parser.add_argument('--functions', type=int, default=10)
+    parser.add_argument('--invocations', type=int, default=100,
+                        help='invocations per function')
+    parser.add_argument('--logs', type=int, default=1000,
+                        help='rows returned by Log Analytics')
+    parser.add_argument('--throttle-every', type=int, default=0,
+                        help='throttle one request every N with a 429')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', action='append', default=[],
+                        help='run only scenarios containing this text')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as json')
+    args = parser.parse_args()
+
+    dataset = fake_azure.Dataset(args.apps, args.functions,
+                                 args.invocations, args.logs,
+                                 throttle_every=args.throttle_every)
+    with tempfile.TemporaryDirectory() as workdir:
+        server, base_url, certfile = fake_azure.start_server(dataset,
+                                                             workdir)
+        omd_root = os.path.join(workdir, 'site')
+        write_token_cache(omd_root, f'{base_url}/.default')
+        env = agent_env(omd_root, certfile)
+
+        results = []
+        outputs = {}
+        try:
+            for name, command, setup in scenarios(base_url):
+                if args.only and not any(o in name for o in args.only):
+                    continue
+                setup(omd_root)
+                # warm up: page cache, discovery cache and state
+                output = run_agent(command, env)[0]
+                runs = []
+                for _ in range(args.repeat):
+                    setup(omd_root)
+                    runs.append(run_agent(command, env))
+                outputs[name] = output
+                results.append({
+                    'name': name,
+                    'wall_secs': [r[1] for r in runs],
+                    'max_rss_kib': max(r[2] for r in runs),
+                    'output_bytes': len(output.encode()),
+                })
+        finally:
+            server.shutdown()
+
+    plugins = bench_plugins(outputs, args.repeat)
+
+    if args.json:
+        json.dump({
+            'dataset': vars(args),
+            'agents': results,
+            'plugins': [{'name': n, 'secs': t} for n, t in plugins],
+        }, sys.stdout, indent=2)
+        print()
+        return
+
+    print(f'dataset: {args.apps} apps x {args.functions} functions x '
+          f'{args.invocations} invocations, {args.logs} logs')
+    print(f'{"scenario":<44} {"median s":>9} {"min s":>8} '
+          f'{"rss MiB":>8} {"out KiB":>8}')
+    for r in results:
+        print(f'{r["name"]:<44} {statistics.median(r["wall_secs"]):>9.3f} '
+              f'{min(r["wall_secs"]):>8.3f} '
+              f'{r["max_rss_kib"] / 1024:>8.1f} '
+              f'{r["output_bytes"] / 1024:>8.1f}')
+    for name, times in plugins:
+        print(f'{name:<44} {statistics.median(times):>9.4f} '
+              f'{min(times):>8.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,468 @@
+"""Fake Azure endpoints serving a synthetic dataset for the benchmarks.
+
+Serves over HTTPS (the Azure SDKs refuse to send bearer tokens over
+plain http) the subset of the APIs used by the special agents:
+
+- ARM: list the sites of a resource group and the functions of a site;
+- App Insights: query the requests of an app (raw, aggregated and
+  incremental query shapes, told apart by the KQL text) and get their
+  pre-aggregated metrics in a batch;
+- Log Analytics: query the logs of a resource.
+
+The dataset is fully determined by the command line, so that runs are
+comparable across commits.  Optionally, one request every N is
+throttled with a 429 response, to exercise the retries of the agents.
+"""
+
+import argparse
+import datetime
+import gzip
+import ipaddress
+import json
+import os
+import random
+import re
+import ssl
+import sys
+import threading
+import urllib.parse
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+RESPONSE_CHUNK_BYTES = 64 * 1024
+
+
+class Dataset:
+    """Synthetic function apps, functions and invocations."""
+
+    def __init__(self, apps, functions, invocations, logs, seed=0,
+                 throttle_every=0):
+        self.apps = apps
+        self.functions = functions
+        self.invocations = invocations
+        self.logs = logs
+        self.seed = seed
+        self.throttle_every = throttle_every
+        self._requests = 0
+        self._lock = threading.Lock()
+
+    def throttled(self):
+        """Whether to throttle the current request."""
+        if not self.throttle_every:
+            return False
+        with self._lock:
+            self._requests += 1
+            return self._requests % self.throttle_every == 0
+
+    def app_name(self, i):
+        return f'bench-func-{i:03d}'
+
+    def function_name(self, i):
+        return f'Function{i:03d}'
+
+    def function_config(self, i):
+        # one every four functions is a timer, the others are http
+        if i % 4 == 0:
+            binding = {'type': 'timerTrigger', 'schedule': '0 */5 * * * *'}
+        else:
+            binding = {'type': 'httpTrigger', 'methods': ['get', 'post']}
+        return {'name': self.function_name(i), 'bindings': [binding]}
+
+    def requests(self):
+        """Yield (app, function, timestamp, success, code, duration)."""
+        rnd = random.Random(self.seed)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for a in range(self.apps):
+            for f in range(self.functions):
+                timer = f % 4 == 0
+                for n in range(self.invocations):
+                    timestamp = now - datetime.timedelta(seconds=n * 30)
+                    failed = rnd.random() < 0.02
+                    if timer:
+                        code = 1 if failed else 0
+                    else:
+                        code = 500 if failed else 200
+                    yield (self.app_name(a), self.function_name(f),
+                           timestamp.isoformat(), not failed, code,
+                           round(rnd.uniform(5, 2000), 3))
+
+
+def _column(name, type_):
+    return {'name': name, 'type': type_}
+
+
+def _table(columns, rows):
+    """Encode a query response, yielding it in chunks."""
+    head = json.dumps({'name': 'PrimaryResult', 'columns': columns})
+    buf = '{"tables":[' + head[:-1] + ',"rows":['
+    sep = ''
+    for row in rows:
+        buf += sep + json.dumps(row)
+        sep = ','
+        if len(buf) >= RESPONSE_CHUNK_BYTES:
+            yield buf.encode()
+            buf = ''
+    yield (buf + ']}]}').encode()
+
+
+def _raw_rows(dataset, with_id, functions=None):
+    for i, (app, func, ts, success, code, duration) in \
+            enumerate(dataset.requests()):
+        if functions is not None and f'{app}/{func}' not in functions:
+            continue
+        row = [ts, func, str(success), str(code), duration, app]
+        if with_id:
+            row.append(f'{i:032x}')
+        yield row
+
+
+def _sampled_rows(dataset, size, timers):
+    # every log of the timers, size random ones of the other functions,
+    # with an itemCount as if App Insights sampled one request in three
+    rnd = random.Random(dataset.seed)
+    logs = {}
+    for row in _raw_rows(dataset, False):
+        logs.setdefault(f'{row[5]}/{row[1]}', []).append(row)
+    for function, rows in logs.items():
+        timer = function in timers
+        items = len(rows) if timer else 3 * len(rows)
+        kept = rows if timer else rnd.sample(rows, min(size, len(rows)))
+        for row in kept:
+            yield [*row, 1 if timer else 3, len(rows), items]
+
+
+def _aggregated_rows(dataset, recent):
+    stats = {}
+    for app, func, ts, success, code, duration in dataset.requests():
+        s = stats.setdefault((app, func), [0, 0, 0.0, 0.0, [], [0, 0, 0]])
+        s[0] += 1
+        s[1] += not success or code > 399
+        if code // 100 in (2, 4, 5):
+            s[5][(2, 4, 5).index(code // 100)] += 1
+        s[2] += duration
+        s[3] = max(s[3], duration)
+        if len(s[4]) < recent:
+            s[4].append({'timestamp': ts, 'success': str(success),
+                         'resultCode': str(code), 'duration': duration})
+    for (app, func), (count, failures, total, dmax, last, statuses) in \
+            stats.items():
+        yield [app, func, count, failures, *statuses, total / count, dmax,
+               dmax * 0.5, dmax * 0.95, dmax * 0.99, json.dumps(last)]
+
+
+RAW_COLUMNS = [
+    _column('timestamp', 'datetime'),
+    _column('operation_Name', 'string'),
+    _column('success', 'string'),
+    _column('resultCode', 'string'),
+    _column('duration', 'real'),
+    _column('cloud_RoleName', 'string'),
+]
+AGGREGATED_COLUMNS = [
+    _column('cloud_RoleName', 'string'),
+    _column('operation_Name', 'string'),
+    _column('invocations', 'long'),
+    _column('failures', 'long'),
+    _column('status_2xx', 'long'),
+    _column('status_4xx', 'long'),
+    _column('status_5xx', 'long'),
+    _column('duration_avg', 'real'),
+    _column('duration_max', 'real'),
+    _column('duration_p50', 'real'),
+    _column('duration_p95', 'real'),
+    _column('duration_p99', 'real'),
+    _column('recent', 'dynamic'),
+]
+RECENT_RE = re.compile(r'\(top (\d+) by timestamp desc\)')
+SAMPLE_RE = re.compile(r'make_list\(pack_all\(\),\s*(\d+)\)')
+FUNCTIONS_RE = re.compile(r'"([^"/]+/[^"]+)"')
+SAMPLE_SIZE_RE = re.compile(r'\(sample (\d+)\)')
+BUCKETS_RE = re.compile(
+    r'bin_at\(TimeGenerated, (\d+)s, datetime\(([^)]+)\)\)')
+SAMPLED_COLUMNS = RAW_COLUMNS + [
+    _column('itemCount', 'int'),
+    _column('rows', 'long'),
+    _column('items', 'long'),
+]
+
+
+def appinsights_response(dataset, query):
+    m = SAMPLE_SIZE_RE.search(query)
+    if m:
+        # sampled query
+        size = int(m.group(1))
+        timers = set(FUNCTIONS_RE.findall(query))
+        return _table(SAMPLED_COLUMNS, _sampled_rows(dataset, size, timers))
+    if 'summarize' in query:
+        m = RECENT_RE.search(query)
+        recent = int(m.group(1)) if m else 10
+        return _table(AGGREGATED_COLUMNS, _aggregated_rows(dataset, recent))
+    if 'datetime(' in query:
+        # incremental query: raw logs with their id
+        return _table(RAW_COLUMNS + [_column('id', 'string')],
+                      _raw_rows(dataset, True))
+    if 'strcat(' in query:
+        # logs of the listed "app/function" only
+        functions = set(FUNCTIONS_RE.findall(query))
+        return _table(RAW_COLUMNS, _raw_rows(dataset, False, functions))
+    return _table(RAW_COLUMNS, _raw_rows(dataset, False))
+
+
+def _metric_segments(values, dims, metric, aggregation):
+    """Nest {segment values: [metric values]} like the metrics API."""
+    if not dims:
+        values = [v for vs in values.values() for v in vs]
+        if aggregation == 'sum':
+            value = sum(values)
+        elif aggregation == 'max':
+            value = max(values)
+        else:
+            value = sum(values) / len(values)
+        return {metric: {aggregation: value}}
+    groups = {}
+    for key, vs in values.items():
+        groups.setdefault(key[0], {})[key[1:]] = vs
+    return {'segments': [
+        {dims[0]: group, **_metric_segments(sub, dims[1:], metric,
+                                            aggregation)}
+        for group, sub in groups.items()
+    ]}
+
+
+def appinsights_metrics_response(dataset, batch):
+    requests = list(dataset.requests())
+    results = []
+    for item in batch:
+        params = item['parameters']
+        metric = params['metricId']
+        dims = params['segment'].split(',')
+        values = {}
+        for app, func, ts, success, code, duration in requests:
+            dim_values = {'cloud/roleName': app, 'request/name': func,
+                          'request/resultCode': str(code)}
+            key = tuple(dim_values[d] for d in dims)
+            if metric == 'requests/count':
+                value = 1
+            elif metric == 'requests/failed':
+                value = 0 if success else 1
+            else:
+                value = duration
+            values.setdefault(key, []).append(value)
+        segments = _metric_segments(values, dims, metric,
+                                    params['aggregation'])
+        results.append({'id': item['id'], 'status': 200,
+                        'body': {'value': segments}})
+    return results
+
+
+def loganalytics_response(dataset, query):
+    rnd = random.Random(dataset.seed)
+    logs = [{'TimeGenerated': f'2024-01-01T00:00:{i % 60:02d}Z',
+             'Level': rnd.choice(['Error', 'Warning']),
+             'Message': f'synthetic log line {i}'}
+            for i in range(dataset.logs)]
+    if '| count' in query:
+        return _table([_column('Count', 'long')], [[len(logs)]])
+    m = BUCKETS_RE.search(query)
+    if m:
+        # the logs spread over an hour from the start of the window
+        bucket_secs = int(m.group(1))
+        start = datetime.datetime.fromisoformat(m.group(2))
+        counts = {}
+        for i in range(len(logs)):
+            offset = i * 7 % 3600 // bucket_secs * bucket_secs
+            counts[offset] = counts.get(offset, 0) + 1
+        return _table(
+            [_column('Bucket', 'datetime'), _column('Count', 'long')],
+            [[(start + datetime.timedelta(seconds=offset)).isoformat(),
+              count] for offset, count in sorted(counts.items())])
+    m = SAMPLE_RE.search(query)
+    if m:
+        return _table([_column('Count', 'long'), _column('Sample', 'dynamic')],
+                      [[len(logs), json.dumps(logs[:int(m.group(1))])]])
+    columns = [_column(k, 'string') for k in logs[0]] if logs else []
+    return _table(columns, ([log[k] for k in log] for log in logs))
+
+
+class FakeAzureHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, obj, status=200):
+        self._send_chunks([json.dumps(obj).encode()], status)
+
+    def _send_chunks(self, chunks, status=200):
+        encoding = None
+        accepted = self.headers.get('Accept-Encoding', '')
+        if 'gzip' in accepted:
+            encoding = 'gzip'
+            compressor = zlib.compressobj(wbits=31)
+        elif 'deflate' in accepted:
+            encoding = 'deflate'
+            compressor = zlib.compressobj()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.end_headers()
+        for chunk in chunks:
+            if encoding:
+                chunk = compressor.compress(chunk)
+            self._write_chunk(chunk)
+        if encoding:
+            self._write_chunk(compressor.flush())
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _write_chunk(self, chunk):
+        if chunk:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return json.loads(body) if body else {}
+
+    def _throttle(self):
+        if not self.server.dataset.throttled():
+            return False
+        body = json.dumps({'error': {'code': 'TooManyRequests',
+                                     'message': 'throttled'}}).encode()
+        self.send_response(429)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(body)
+        return True
+
+    def do_GET(self):
+        if self._throttle():
+            return
+        dataset = self.server.dataset
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path.rstrip('/')
+        parts = path.split('/')
+
+        if path.endswith('/providers/Microsoft.Web/sites'):
+            self._send_json({'value': [
+                {'id': f'{path}/{dataset.app_name(i)}',
+                 'name': dataset.app_name(i),
+                 'kind': 'functionapp,linux',
+                 'location': 'westeurope',
+                 'properties': {}}
+                for i in range(dataset.apps)]})
+        elif path.endswith('/functions') and '/sites/' in path:
+            app = parts[-2]
+            self._send_json({'value': [
+                {'id': f'{path}/{dataset.function_name(i)}',
+                 'name': f'{app}/{dataset.function_name(i)}',
+                 'properties': {'config': dataset.function_config(i)}}
+                for i in range(dataset.functions)]})
+        elif path.startswith('/v1/apps/') and path.endswith('/query'):
+            query = urllib.parse.parse_qs(url.query).get('query', [''])[0]
+            self._send_chunks(appinsights_response(dataset, query))
+        else:
+            self._send_json({'error': {'code': 'NotFound',
+                                       'message': path}}, 404)
+
+    def do_POST(self):
+        if self._throttle():
+            self._body()
+            return
+        path = urllib.parse.urlsplit(self.path).path
+        if path.startswith('/v1/apps/') and path.endswith('/metrics'):
+            self._send_json(
+                appinsights_metrics_response(self.server.dataset,
+                                             self._body()))
+        elif path.startswith('/v1/') and path.endswith('/query'):
+            query = self._body().get('query', '')
+            self._send_chunks(
+                loganalytics_response(self.server.dataset, query))
+        else:
+            self._send_json({'error': {'code': 'NotFound',
+                                       'message': path}}, 404)
+
+
+def write_certificate(certfile, keyfile):
+    """Write a self-signed certificate valid for 127.0.0.1."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, '127.0.0.1')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = x509.CertificateBuilder() \
+        .subject_name(name) \
+        .issuer_name(name) \
+        .public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now - datetime.timedelta(days=1)) \
+        .not_valid_after(now + datetime.timedelta(days=1)) \
+        .add_extension(x509.SubjectAlternativeName(
+            [x509.IPAddress(ipaddress.ip_address('127.0.0.1'))]),
+            critical=False) \
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None),
+                       critical=True) \
+        .sign(key, hashes.SHA256())
+    with open(certfile, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(keyfile, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM,
+                                  serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+
+
+def start_server(dataset, workdir, port=0):
+    """Start the fake server in a thread.
+
+    Return (server, base_url, certfile): clients must trust certfile,
+    e.g. via the SSL_CERT_FILE environment variable.
+    """
+    certfile = os.path.join(workdir, 'fake_azure.pem')
+    keyfile = os.path.join(workdir, 'fake_azure.key')
+    write_certificate(certfile, keyfile)
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeAzureHandler)
+    server.daemon_threads = True
+    server.dataset = dataset
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f'https://127.0.0.1:{server.server_port}', certfile
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--workdir', default='.')
+    parser.add_argument('--apps', type=int, default=5)
+    parser.add_argument('--functions', type=int, default=10)
+    parser.add_argument('--invocations', type=int, default=100)
+    parser.add_argument('--logs', type=int, default=100)
+    parser.add_argument('--throttle-every', type=int, default=0)
+    args = parser.parse_args()
+
+    dataset = Dataset(args.apps, args.functions, args.invocations, args.logs,
+                      throttle_every=args.throttle_every)
+    server, base_url, certfile = start_server(dataset, args.workdir,
+                                              args.port)
+    print(f'serving {base_url}, certificate {certfile}', file=sys.stderr)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
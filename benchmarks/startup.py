@@ -0,0 +1,175 @@
+"""Check the start-up budget of the special agents.
+
+Each scenario runs an agent with `python -X importtime` against the
+fake Azure server of fake_azure.py, records the time spent importing
+modules and checks it against a budget.  Scenarios also list modules
+that their code path must not import at all, e.g. the ARM SDK when the
+discovery is cached.
+
+The exit status is 1 when a scenario is over budget or imports a
+forbidden module, so that the check can run in CI.
+"""
+
+import argparse
+import fcntl
+import glob
+import os
+import sys
+import tempfile
+import time
+
+import bench
+import fake_azure
+
+
+def import_times(stderr):
+    """Return {module: cumulative usecs} of the top level imports."""
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip() == 'cumulative':
+            # header
+            continue
+        # nested imports are indented below their parent
+        if not name[1:].startswith(' '):
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def imported(stderr):
+    return {
+        line.rsplit('|', 1)[1].strip()
+        for line in stderr.splitlines()
+        if line.startswith('import time:')
+    }
+
+
+def state_dir(omd_root):
+    return os.path.join(omd_root, 'tmp', 'check_mk', 'agent_azurefunctions')
+
+
+def wait_collector_cache(omd_root, timeout=30):
+    deadline = time.time() + timeout
+    pattern = os.path.join(state_dir(omd_root), 'collector-*.json')
+    while not glob.glob(pattern):
+        if time.time() > deadline:
+            raise RuntimeError('collector did not write its cache')
+        time.sleep(0.1)
+
+
+def stop_collectors(omd_root, timeout=30):
+    # a collector exits at its next refresh once nobody reads its cache
+    for path in glob.glob(os.path.join(state_dir(omd_root),
+                                       'collector-*.read')):
+        os.unlink(path)
+    deadline = time.time() + timeout
+    for path in glob.glob(os.path.join(state_dir(omd_root),
+                                       'collector-*.lock')):
+        with open(path) as lockfile:
+            while True:
+                try:
+                    fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.time() > deadline:
+                        raise RuntimeError('collector did not exit')
+                    time.sleep(0.1)
+
+
+def scenarios(base_url):
+    """Return (name, command, budget ms, forbidden modules, prepare)
+    tuples; prepare(command, env, omd_root) runs before the measured
+    run.  Budgets include the interpreter start-up imports."""
+
+    def warm_up(command, env, omd_root):
+        bench.run_agent(command, env)
+
+    def start_collector(command, env, omd_root):
+        bench.run_agent(command, env)
+        wait_collector_cache(omd_root)
+
+    heavy = ['azure', 'aiohttp', 'cryptography']
+    return [
+        ('azurefunctions collector cache hit',
+         bench.azurefunctions_args(base_url, '--query-mode', 'aggregated',
+                                   '--collector-interval', '1'),
+         150,
+         heavy,
+         start_collector),
+        ('azurefunctions cached discovery',
+         bench.azurefunctions_args(base_url, '--query-mode', 'aggregated',
+                                   '--discovery-cache-ttl', '3600'),
+         350,
+         ['azure'],
+         warm_up),
+        ('azurefunctions cached discovery, raw',
+         bench.azurefunctions_args(base_url, '--query-mode', 'raw',
+                                   '--discovery-cache-ttl', '3600'),
+         350,
+         ['azure'],
+         warm_up),
+        ('azuremonitor cached token',
+         bench.azuremonitor_args(base_url),
+         450,
+         ['azure.identity'],
+         warm_up),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget-factor', type=float, default=1.0,
+                        help='scale the budgets, e.g. on slow machines')
+    parser.add_argument('--only', action='append', default=[],
+                        help='run only scenarios containing this text')
+    parser.add_argument('--top', type=int, default=5,
+                        help='show the N slowest top level imports')
+    args = parser.parse_args()
+
+    failed = False
+    dataset = fake_azure.Dataset(apps=2, functions=4, invocations=10,
+                                 logs=10)
+    with tempfile.TemporaryDirectory() as workdir:
+        server, base_url, certfile = fake_azure.start_server(dataset,
+                                                             workdir)
+        omd_root = os.path.join(workdir, 'site')
+        bench.write_token_cache(omd_root, f'{base_url}/.default')
+        env = bench.agent_env(omd_root, certfile)
+
+        try:
+            for name, command, budget_ms, forbidden, prepare in \
+                    scenarios(base_url):
+                if args.only and not any(o in name for o in args.only):
+                    continue
+                prepare(command, env, omd_root)
+                stderr = bench.run_agent(
+                    [command[0], '-X', 'importtime', *command[1:]], env)[3]
+
+                times = import_times(stderr)
+                total_ms = sum(times.values()) / 1000
+                unwanted = sorted(
+                    module for module in imported(stderr)
+                    if any(module == f or module.startswith(f + '.')
+                           for f in forbidden))
+                budget_ms *= args.budget_factor
+                ok = total_ms <= budget_ms and not unwanted
+                failed = failed or not ok
+
+                print(f'{"ok" if ok else "FAIL":<5}{name}: imports '
+                      f'{total_ms:.1f} ms (budget {budget_ms:.0f} ms)')
+                for module, usecs in sorted(times.items(),
+                                            key=lambda i: -i[1])[:args.top]:
+                    print(f'       {usecs / 1000:8.1f} ms  {module}')
+                if unwanted:
+                    print(f'       forbidden imports: {", ".join(unwanted)}')
+        finally:
+            stop_collectors(omd_root)
+            server.shutdown()
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
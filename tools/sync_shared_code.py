@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Copy the code shared by the special agents.
+
+The agents ship in separate packages and cannot import a common
+module: the blocks of agent_azurefunctions between the lines
+"# BEGIN SHARED <name>" and "# END SHARED <name>" are copied as is into
+the blocks with the same name of agent_azuremonitor.
+
+With --check nothing is written, and the exit status tells whether the
+copies are up to date, e.g. in CI.
+"""
+
+import argparse
+import difflib
+import os
+import re
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE = os.path.join(ROOT, 'azurefunctions', 'azurefunctions', 'libexec',
+                      'agent_azurefunctions')
+COPIES = [
+    os.path.join(ROOT, 'azuremonitor', 'azuremonitor', 'libexec',
+                 'agent_azuremonitor'),
+]
+
+BLOCK_RE = re.compile(
+    r'^# BEGIN SHARED (?P<name>\S+)\n(?P<code>.*?)^# END SHARED (?P=name)\n',
+    re.MULTILINE | re.DOTALL)
+
+
+def _blocks(text):
+    return {m['name']: m['code'] for m in BLOCK_RE.finditer(text)}
+
+
+def synced(source, copy, copy_path):
+    """The copy with its blocks replaced by those of source."""
+    blocks = _blocks(source)
+    names = set(_blocks(copy))
+    if names != set(blocks):
+        sys.exit(f'{copy_path}: shared blocks '
+                 f'{", ".join(sorted(names))} instead of '
+                 f'{", ".join(sorted(blocks))}')
+    return BLOCK_RE.sub(
+        lambda m: f'# BEGIN SHARED {m["name"]}\n{blocks[m["name"]]}'
+        f'# END SHARED {m["name"]}\n', copy)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--check',
+        action='store_true',
+        help='only tell whether the copies are up to date',
+    )
+    args = parser.parse_args()
+
+    with open(SOURCE) as f:
+        source = f.read()
+    outdated = False
+    for path in COPIES:
+        with open(path) as f:
+            copy = f.read()
+        new = synced(source, copy, path)
+        if new == copy:
+            continue
+        outdated = True
+        if args.check:
+            sys.stdout.writelines(difflib.unified_diff(
+                copy.splitlines(keepends=True),
+                new.splitlines(keepends=True),
+                path, f'{path} (synced)'))
+        else:
+            with open(path, 'w') as f:
+                f.write(new)
+            print(f'updated {os.path.relpath(path, ROOT)}')
+    if args.check and outdated:
+        sys.exit('shared code out of sync, run tools/sync_shared_code.py')
+
+
+if __name__ == '__main__':
+    main()